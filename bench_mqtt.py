@@ -0,0 +1,466 @@
+"""
+短信验证码链路压测工具，不需要外部 MQTT 服务器，可完全离线运行
+
+在本进程内启动一个精简的 MQTT 3.1.1 服务器 (支持 QoS 0/1/2 和持久会话)，
+用 MqttCodeListener 订阅，再用另一个 paho 客户端按给定速率发布各种格式的验证码消息
+(标准 JSON、双重编码 JSON、全角标点、宽松文本、其他用户、无法解析的消息)，统计：
+    - _on_message 的纯解析吞吐 (不经过网络)
+    - 突发发布时从 publish 到 _on_message 收下的延迟 p50/p99
+    - 模拟登录流程：点击发送 -> 发布 -> get_code() 返回 的端到端延迟
+    - --kick 时每轮发布前先踢掉监听端的连接，验证断线期间的验证码能在重连后补收
+有验证码丢失、端到端轮次失败，或延迟超过 --max-burst-p99-ms / --max-handoff-ms 时以状态码 1 退出，可直接用于 CI
+
+示例：
+    python bench_mqtt.py
+    python bench_mqtt.py --count 20000 --rate 0 --qos 1
+    python bench_mqtt.py --rounds 5 --kick
+"""
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import CallbackAPIVersion
+
+from bench_wsproxy import percentile
+from mqtt_handler import MqttCodeListener
+from utils import configure_log
+
+TOPIC = 'sms/verification'
+USERNAME = 'bench_user'
+LISTENER_ID = 'bench_listener'
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+# ---------------------------------------------------------------------------
+# 消息格式：_on_message 需要兼容的各种写法
+# ---------------------------------------------------------------------------
+
+def make_payload(variant, code, username=USERNAME):
+    return _make_text(variant, code, username).encode('utf-8') if variant != 'garbage' else b'\xff\xfe\x00{{{'
+
+
+def _make_text(variant, code, username):
+    if variant == 'json':
+        return json.dumps({'username': username, 'code': code, 'timestamp': time.time()})
+    if variant == 'double_json':
+        return json.dumps(json.dumps({'username': username, 'code': code}))
+    if variant == 'fullwidth':
+        return f'{{“username”：“{username}”，“code”：“{code}”}}'
+    if variant == 'loose':
+        return f'username: {username}, code: {code}'
+    if variant == 'other_user':
+        return json.dumps({'username': 'someone_else', 'code': code})
+    if variant == 'no_code':
+        return json.dumps({'username': username, 'msg': 'hello'})
+    raise ValueError(variant)
+
+
+# 能被收下的格式，以及应当被忽略的格式
+ACCEPTED_VARIANTS = ('json', 'double_json', 'fullwidth', 'loose')
+REJECTED_VARIANTS = ('other_user', 'no_code', 'garbage')
+ALL_VARIANTS = ACCEPTED_VARIANTS + REJECTED_VARIANTS
+
+
+# ---------------------------------------------------------------------------
+# 本地 MQTT 服务器 (仅实现压测需要的 3.1.1 子集)
+# ---------------------------------------------------------------------------
+
+def encode_packet(packet_type, flags, body):
+    n = len(body)
+    length = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        length.append(byte | 0x80 if n else byte)
+        if not n:
+            break
+    return bytes([packet_type << 4 | flags]) + bytes(length) + body
+
+
+def encode_str(s):
+    data = s.encode('utf-8') if isinstance(s, str) else s
+    return len(data).to_bytes(2, 'big') + data
+
+
+def topic_matches(pattern, topic):
+    p, t = pattern.split('/'), topic.split('/')
+    for i, part in enumerate(p):
+        if part == '#':
+            return True
+        if i >= len(t) or (part != '+' and part != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+class Session:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscriptions = {}  # topic filter -> qos
+        self.queue = []          # 离线期间的 (topic, payload, qos)
+        self.writer = None
+        self.next_id = 0
+
+    def packet_id(self):
+        self.next_id = self.next_id % 65535 + 1
+        return self.next_id
+
+
+class LocalBroker:
+    """
+    在独立线程的事件循环里运行的精简 MQTT 服务器
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.loop = None
+        self.port = None
+        self._ready = threading.Event()
+        self._server = None
+
+    def start(self):
+        threading.Thread(target=self._run, name='bench-broker', daemon=True).start()
+        self._ready.wait(10)
+        return self.port
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self._server = self.loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', 0))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self.loop.run_forever()
+
+    def kick(self, client_id):
+        """断开某个客户端 (不发 DISCONNECT)，模拟网络闪断"""
+        def _kick():
+            session = self.sessions.get(client_id)
+            if session is not None and session.writer is not None:
+                session.writer.transport.abort()
+        self.loop.call_soon_threadsafe(_kick)
+
+    def stop(self):
+        def _stop():
+            self._server.close()
+            # 断开所有客户端，处理协程随之退出，稍后再停事件循环
+            for session in self.sessions.values():
+                if session.writer is not None:
+                    session.writer.transport.abort()
+            self.loop.call_later(0.1, self.loop.stop)
+        self.loop.call_soon_threadsafe(_stop)
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def _handle(self, reader, writer):
+        session = None
+        try:
+            packet_type, _, body = await self._read_packet(reader)
+            if packet_type != CONNECT:
+                return
+            name_len = int.from_bytes(body[:2], 'big')
+            pos = 2 + name_len + 1
+            connect_flags = body[pos]
+            pos += 3
+            id_len = int.from_bytes(body[pos:pos + 2], 'big')
+            client_id = body[pos + 2:pos + 2 + id_len].decode('utf-8')
+            clean = bool(connect_flags & 0x02)
+
+            session = self.sessions.get(client_id)
+            present = session is not None and not clean
+            if session is not None and session.writer is not None:
+                session.writer.transport.abort()
+            if not present:
+                session = self.sessions[client_id] = Session(client_id)
+            session.clean = clean
+            session.writer = writer
+            writer.write(encode_packet(CONNACK, 0, bytes([1 if present else 0, 0])))
+            # 补发离线期间的消息
+            queued, session.queue = session.queue, []
+            for topic, payload, qos in queued:
+                self._deliver(session, topic, payload, qos)
+
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_len = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + topic_len].decode('utf-8')
+                    pos = 2 + topic_len
+                    if qos:
+                        packet_id = body[pos:pos + 2]
+                        pos += 2
+                        writer.write(encode_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+                    self._route(topic, body[pos:], qos)
+                elif packet_type == PUBREL:
+                    writer.write(encode_packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == PUBREC:
+                    writer.write(encode_packet(PUBREL, 0x02, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    packet_id, pos, granted = body[:2], 2, bytearray()
+                    while pos < len(body):
+                        n = int.from_bytes(body[pos:pos + 2], 'big')
+                        topic_filter = body[pos + 2:pos + 2 + n].decode('utf-8')
+                        qos = body[pos + 2 + n]
+                        pos += 3 + n
+                        session.subscriptions[topic_filter] = qos
+                        granted.append(qos)
+                    writer.write(encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    writer.write(encode_packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+                # PUBACK / PUBCOMP：本服务器不做重发，无需处理
+        except (asyncio.IncompleteReadError, ConnectionError, IndexError):
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    self.sessions.pop(session.client_id, None)
+            writer.close()
+
+    def _route(self, topic, payload, qos):
+        for session in self.sessions.values():
+            granted = [q for f, q in session.subscriptions.items() if topic_matches(f, topic)]
+            if not granted:
+                continue
+            out_qos = min(qos, max(granted))
+            if session.writer is None:
+                # 离线的持久会话只保留 QoS 1/2 消息
+                if out_qos:
+                    session.queue.append((topic, payload, out_qos))
+                continue
+            self._deliver(session, topic, payload, out_qos)
+
+    def _deliver(self, session, topic, payload, qos):
+        body = encode_str(topic)
+        if qos:
+            body += session.packet_id().to_bytes(2, 'big')
+        session.writer.write(encode_packet(PUBLISH, qos << 1, body + payload))
+
+
+# ---------------------------------------------------------------------------
+# 压测
+# ---------------------------------------------------------------------------
+
+class BenchListener(MqttCodeListener):
+    """
+    记录每条验证码被 _on_message 收下的时间
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.accepted = {}
+        self.handled = 0
+
+    def _on_message(self, client, userdata, msg):
+        super()._on_message(client, userdata, msg)
+        self.handled += 1
+        code = self.received_code
+        if code is not None and code not in self.accepted:
+            self.accepted[code] = time.perf_counter()
+
+
+def bench_parse(listener, count):
+    """不经过网络，直接调用 _on_message 测解析吞吐"""
+    messages = [
+        SimpleNamespace(payload=make_payload(ALL_VARIANTS[i % len(ALL_VARIANTS)], f'P{i}'))
+        for i in range(count)
+    ]
+    start = time.perf_counter()
+    for msg in messages:
+        MqttCodeListener._on_message(listener, None, None, msg)
+    elapsed = time.perf_counter() - start
+    print(f"解析: {count} 条 (各种格式轮流)，{elapsed:.3f} s，{count / elapsed:.0f} 条/s")
+
+
+def bench_burst(listener, publisher, count, rate, qos):
+    """按速率突发发布，统计 publish 到 _on_message 收下的延迟"""
+    listener.accepted.clear()
+    listener.handled = 0
+    sent = {}
+    expected = 0
+    interval = 1 / rate if rate else 0
+    start = time.perf_counter()
+    for i in range(count):
+        variant = ALL_VARIANTS[i % len(ALL_VARIANTS)]
+        code = f'B{i}'
+        if variant in ACCEPTED_VARIANTS:
+            expected += 1
+        sent[code] = time.perf_counter()
+        publisher.publish(TOPIC, make_payload(variant, code), qos=qos)
+        if interval:
+            delay = start + (i + 1) * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    deadline = time.monotonic() + 30
+    while listener.handled < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(listener.accepted[code] - sent[code] for code in listener.accepted if code in sent)
+    print(f"突发: 发布 {count} 条 (速率 {rate or '不限'}, QoS {qos})，处理 {listener.handled} 条，"
+          f"收下 {len(latencies)}/{expected} 条，耗时 {elapsed:.3f} s")
+    print(f"  publish -> 收下 p50: {percentile(latencies, 50) * 1000:.3f} ms, "
+          f"p99: {percentile(latencies, 99) * 1000:.3f} ms, "
+          f"max: {latencies[-1] * 1000 if latencies else 0:.3f} ms")
+    return SimpleNamespace(lost=expected - len(latencies), p99=percentile(latencies, 99))
+
+
+def bench_rounds(listener, publisher, broker, rounds, qos, kick):
+    """模拟登录流程：点击发送 -> 发布验证码 -> get_code() 返回"""
+    latencies = []
+    failures = 0
+    for i in range(rounds):
+        # 上一轮之前的旧验证码要被丢弃
+        publisher.publish(TOPIC, make_payload('json', f'STALE{i}'), qos=qos)
+        time.sleep(0.05)
+        listener.mark_code_requested()
+        if kick:
+            broker.kick(LISTENER_ID)
+            time.sleep(0.05)
+        code = f'R{i}'
+        start = time.perf_counter()
+        publisher.publish(TOPIC, make_payload(ACCEPTED_VARIANTS[i % len(ACCEPTED_VARIANTS)], code), qos=qos)
+        got = listener.get_code(timeout=10)
+        if got == code:
+            latencies.append(time.perf_counter() - start)
+        else:
+            failures += 1
+            print(f"  第 {i + 1} 轮: 期望 {code}，实际 {got}")
+
+    latencies.sort()
+    print(f"端到端: {rounds} 轮{' (每轮先断线)' if kick else ''}，成功 {len(latencies)}，失败 {failures}")
+    print(f"  发布 -> get_code() 返回 p50: {percentile(latencies, 50) * 1000:.3f} ms, "
+          f"p99: {percentile(latencies, 99) * 1000:.3f} ms, "
+          f"max: {latencies[-1] * 1000 if latencies else 0:.3f} ms")
+    return SimpleNamespace(failures=failures, p99=percentile(latencies, 99))
+
+
+def check_budgets(burst, rounds, max_burst_p99_ms, max_handoff_ms):
+    """
+    对照阈值检查结果，返回未达标项的说明列表
+    """
+    problems = []
+    if burst.lost:
+        problems.append(f"突发发布丢失 {burst.lost} 条验证码")
+    if max_burst_p99_ms and burst.p99 * 1000 > max_burst_p99_ms:
+        problems.append(f"突发 publish -> 收下 p99 {burst.p99 * 1000:.3f} ms 超过 {max_burst_p99_ms:g} ms")
+    if rounds.failures:
+        problems.append(f"端到端 {rounds.failures} 轮没有拿到本轮的验证码")
+    if max_handoff_ms and rounds.p99 * 1000 > max_handoff_ms:
+        problems.append(f"端到端 发布 -> get_code() 返回 p99 {rounds.p99 * 1000:.3f} ms 超过 {max_handoff_ms:g} ms")
+    return problems
+
+
+class ListenerLoop:
+    """
+    和主程序一样用 run_in_loop 驱动监听端：在后台线程里跑一个 asyncio 事件循环，
+    压测覆盖的是实际使用的 socket 回调、loop_misc 心跳和断线重连退避
+    """
+
+    def __init__(self, listener):
+        # add_reader/add_writer 需要 selector 事件循环 (Windows 默认的 Proactor 不支持)
+        self.loop = asyncio.SelectorEventLoop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='bench-mqtt-loop', daemon=True)
+        self.thread.start()
+        self.task = asyncio.run_coroutine_threadsafe(self._start(listener), self.loop).result()
+
+    @staticmethod
+    async def _start(listener):
+        return asyncio.create_task(listener.run_in_loop())
+
+    async def _cancel(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._cancel(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+
+def wait_connected(client, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not client.is_connected():
+        if time.monotonic() > deadline:
+            raise RuntimeError("连接本地 MQTT 服务器超时")
+        time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='短信验证码链路本地压测')
+    parser.add_argument('--count', type=int, default=5000, help='突发发布的消息数')
+    parser.add_argument('--rate', type=float, default=2000, help='每秒发布条数，0 为不限')
+    parser.add_argument('--qos', type=int, default=2, choices=[0, 1, 2])
+    parser.add_argument('--rounds', type=int, default=20, help='端到端轮数')
+    parser.add_argument('--kick', action='store_true', help='端到端每轮发布前先断开监听端，验证重连补收')
+    parser.add_argument('--max-burst-p99-ms', type=float, default=500,
+                        help='突发发布 publish -> 收下 p99 的上限 (毫秒)，0 为不检查')
+    parser.add_argument('--max-handoff-ms', type=float, default=2000,
+                        help='端到端 发布 -> get_code() 返回 p99 的上限 (毫秒，--kick 时包含重连)，0 为不检查')
+    parser.add_argument('--log-level', default='WARNING', help='日志级别')
+    args = parser.parse_args()
+    configure_log({'log_level': args.log_level})
+
+    broker = LocalBroker()
+    port = broker.start()
+
+    config = {
+        'mqtt_host': '127.0.0.1', 'mqtt_port': port, 'mqtt_topic': TOPIC, 'mqtt_qos': args.qos,
+        'mqtt_client_id': LISTENER_ID, 'username': USERNAME,
+        'mqtt_reconnect_max_delay_seconds': 1,
+    }
+    listener = BenchListener(config)
+    listener_loop = ListenerLoop(listener)
+    wait_connected(listener.client)
+
+    publisher = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id='bench_publisher')
+    # 压测时发布端不限制在途消息数
+    publisher.max_inflight_messages_set(0)
+    publisher.max_queued_messages_set(0)
+    publisher.connect('127.0.0.1', port)
+    publisher.loop_start()
+    wait_connected(publisher)
+    # 等订阅生效
+    time.sleep(0.2)
+
+    try:
+        bench_parse(listener, args.count)
+        burst = bench_burst(listener, publisher, args.count, args.rate, args.qos)
+        rounds = bench_rounds(listener, publisher, broker, args.rounds, args.qos, args.kick)
+    finally:
+        publisher.loop_stop()
+        publisher.disconnect()
+        listener_loop.stop()
+        broker.stop()
+
+    problems = check_budgets(burst, rounds, args.max_burst_p99_ms, args.max_handoff_ms)
+    for problem in problems:
+        print(f"未通过: {problem}")
+    if problems:
+        sys.exit(1)
+    print("通过")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+本地代理压测工具，不需要真实 Ukey，Linux 下可完全离线运行
+
+用一个本地 TLS WebSocket 服务模拟机器 B 上的 Ukey 助手 (回显或返回指定大小的报文)，
+再按给定并发和报文大小通过 wsproxy 发请求，统计每次请求的延迟 p50/p99 和吞吐量。
+
+示例：
+    python bench_wsproxy.py --connections 8 --messages 200 --size 4096
+    python bench_wsproxy.py --relay-mode buffered --pool-size 4 --response-size 262144
+    python bench_wsproxy.py --direct        # 直连模拟服务，作为对照
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import socket
+import ssl
+import tempfile
+import time
+
+import utils
+import wsproxy
+from utils import configure_log, generate_self_signed_cert
+from wsframe import unmask, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def encode_frame(payload, opcode=OP_BINARY, mask=False):
+    header = bytearray([0x80 | opcode])
+    n = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if n < 126:
+        header.append(mask_bit | n)
+    elif n < 65536:
+        header.append(mask_bit | 126)
+        header += n.to_bytes(2, 'big')
+    else:
+        header.append(mask_bit | 127)
+        header += n.to_bytes(8, 'big')
+    if mask:
+        key = os.urandom(4)
+        return bytes(header) + key + unmask(payload, key)
+    return bytes(header) + payload
+
+
+async def read_frame(reader):
+    """读一个完整帧，返回 (opcode, payload)"""
+    b0, b1 = await reader.readexactly(2)
+    n = b1 & 0x7F
+    if n == 126:
+        n = int.from_bytes(await reader.readexactly(2), 'big')
+    elif n == 127:
+        n = int.from_bytes(await reader.readexactly(8), 'big')
+    key = await reader.readexactly(4) if b1 & 0x80 else None
+    payload = await reader.readexactly(n)
+    if key:
+        payload = unmask(payload, key)
+    return b0 & 0x0F, payload
+
+
+# ---------------------------------------------------------------------------
+# 模拟的 Ukey 助手
+# ---------------------------------------------------------------------------
+
+async def fake_ukey_handler(reader, writer, response_size):
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+        key = None
+        for line in request.split(b'\r\n'):
+            if line.lower().startswith(b'sec-websocket-key:'):
+                key = line.split(b':', 1)[1].strip()
+        if key is None:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+        scripted = os.urandom(response_size) if response_size else None
+        while True:
+            opcode, payload = await read_frame(reader)
+            if opcode == OP_CLOSE:
+                writer.write(encode_frame(payload, OP_CLOSE))
+                break
+            if opcode == OP_PING:
+                writer.write(encode_frame(payload, OP_PONG))
+                continue
+            # 回显，或返回固定大小的报文 (模拟签名/证书等大块返回)
+            writer.write(encode_frame(scripted if scripted is not None else payload, opcode))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_fake_ukey(ssl_ctx, response_size):
+    server = await asyncio.start_server(
+        lambda r, w: fake_ukey_handler(r, w, response_size), '127.0.0.1', 0, ssl=ssl_ctx
+    )
+    return server, server.sockets[0].getsockname()[1]
+
+
+# ---------------------------------------------------------------------------
+# 压测客户端
+# ---------------------------------------------------------------------------
+
+async def run_client(port, messages, size, latencies, counters):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=ctx)
+    key = base64.b64encode(os.urandom(16))
+    writer.write(b'GET /xtxapp HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 b'Sec-WebSocket-Version: 13\r\nSec-WebSocket-Key: ' + key + b'\r\n\r\n')
+    await reader.readuntil(b'\r\n\r\n')
+
+    payload = os.urandom(size)
+    for _ in range(messages):
+        start = time.perf_counter()
+        writer.write(encode_frame(payload, OP_BINARY, mask=True))
+        opcode, response = await read_frame(reader)
+        latencies.append(time.perf_counter() - start)
+        counters['bytes'] += size + len(response)
+
+    writer.write(encode_frame(b'', OP_CLOSE, mask=True))
+    try:
+        await read_frame(reader)
+    except asyncio.IncompleteReadError:
+        pass
+    writer.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"端口 {port} 未在 {timeout} 秒内就绪")
+
+
+async def bench(args):
+    work_dir = tempfile.mkdtemp(prefix='wsproxy_bench_')
+    # 代理和模拟服务都用临时目录里的证书，不动程序目录下的 certs
+    utils.get_base_path = wsproxy.get_base_path = lambda: work_dir
+    configure_log({'log_level': args.log_level})
+
+    _, cert_path, key_path = generate_self_signed_cert(os.path.join(work_dir, 'certs'))
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(cert_path, key_path)
+
+    fake_server, fake_port = await start_fake_ukey(server_ctx, args.response_size)
+
+    proxy_task = None
+    if args.direct:
+        target_port = fake_port
+        label = 'direct'
+    else:
+        target_port = free_port()
+        config = {
+            'proxy_relay_mode': args.relay_mode,
+            'proxy_pool_size': args.pool_size,
+            'proxy_log_payload': args.log_payload,
+        }
+        proxy_task = asyncio.create_task(
+            wsproxy.start_server_async(target_port, '127.0.0.1', fake_port, config))
+        await wait_port(target_port)
+        # 等连接池预热
+        await asyncio.sleep(0.5 if args.pool_size else 0)
+        label = f"proxy/{args.relay_mode}/pool={args.pool_size}"
+
+    latencies = []
+    counters = {'bytes': 0}
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(target_port, args.messages, args.size, latencies, counters)
+        for _ in range(args.connections)
+    ])
+    elapsed = time.perf_counter() - start
+
+    if proxy_task is not None:
+        proxy_task.cancel()
+        try:
+            await proxy_task
+        except asyncio.CancelledError:
+            pass
+    fake_server.close()
+
+    latencies.sort()
+    print(f"模式: {label}")
+    print(f"并发: {args.connections}, 每连接消息数: {args.messages}, 请求大小: {args.size} B, "
+          f"响应大小: {args.response_size or args.size} B")
+    print(f"请求数: {len(latencies)}, 总耗时: {elapsed:.3f} s")
+    print(f"延迟 p50: {percentile(latencies, 50) * 1000:.3f} ms, "
+          f"p99: {percentile(latencies, 99) * 1000:.3f} ms, "
+          f"max: {latencies[-1] * 1000 if latencies else 0:.3f} ms")
+    print(f"吞吐: {counters['bytes'] / elapsed / 1024 / 1024:.2f} MB/s, {len(latencies) / elapsed:.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wsproxy 本地压测')
+    parser.add_argument('--connections', type=int, default=4, help='并发连接数')
+    parser.add_argument('--messages', type=int, default=100, help='每个连接发送的消息数')
+    parser.add_argument('--size', type=int, default=1024, help='每条请求的字节数')
+    parser.add_argument('--response-size', type=int, default=0, help='模拟服务每次返回的字节数，0 为回显')
+    parser.add_argument('--relay-mode', default=wsproxy.RELAY_MODE_STREAM,
+                        choices=[wsproxy.RELAY_MODE_STREAM, wsproxy.RELAY_MODE_BUFFERED])
+    parser.add_argument('--pool-size', type=int, default=0, help='代理的上游预连接数')
+    parser.add_argument('--log-payload', action='store_true', help='开启代理的报文解析日志')
+    parser.add_argument('--log-level', default='WARNING', help='代理日志级别')
+    parser.add_argument('--direct', action='store_true', help='不经过代理，直连模拟服务作为对照')
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
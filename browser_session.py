@@ -0,0 +1,313 @@
+import json
+import os
+import time
+import tracing
+from utils import log, get_base_path
+from metrics import Counter, Gauge
+
+BROWSER_MEMORY_BYTES = Gauge('browser_memory_bytes', '保活期间浏览器占用的内存 (装了 psutil 时为各进程 RSS 之和，否则为页面 JS 堆)')
+BROWSER_CPU_PERCENT = Gauge('browser_cpu_percent', '保活期间浏览器各进程的 CPU 占用 (单核百分比)')
+BROWSER_RECYCLES = Counter('browser_recycles_total', '浏览器超出资源预算后重建页面的次数')
+
+SESSION_FILE = 'session_state.json'
+LOGIN_INPUT_SELECTOR = 'css:input.el-input__inner[placeholder="请输入账号"]'
+# 没有配置 session_dashboard_selector 时，页面加载完后 URL 在 dashboard 上停留这么久 (没被前端路由踢回登录页) 即认为会话有效
+SESSION_SETTLE_SECONDS = 1.5
+
+
+def _base_relative(path):
+    return path if os.path.isabs(path) else os.path.join(get_base_path(), path)
+
+
+def create_page(config):
+    """
+    启动 (或接管已打开的) Chromium；配置了 browser_profile_dir 时使用程序目录下固定的用户数据目录，
+    登录状态、缓存在多次运行之间保留
+    """
+    from DrissionPage import ChromiumPage, ChromiumOptions
+    options = ChromiumOptions()
+    profile_dir = config.get('browser_profile_dir', 'browser_profile')
+    if profile_dir:
+        options.set_user_data_path(_base_relative(profile_dir))
+    # 不单独配置时缓存就在用户数据目录里，同样会保留
+    cache_dir = config.get('browser_cache_dir')
+    if cache_dir:
+        options.set_argument('--disk-cache-dir', _base_relative(cache_dir))
+    cache_mb = int(config.get('browser_cache_size_mb', 0))
+    if cache_mb:
+        options.set_argument('--disk-cache-size', str(cache_mb * 1024 * 1024))
+    page = ChromiumPage(options)
+    apply_blocked_urls(page, config.get('browser_block_urls'))
+    return page
+
+
+def apply_blocked_urls(tab, blocked_urls):
+    """
+    屏蔽统计、广告等与登录无关的第三方资源，支持 * 通配
+    CDP 的屏蔽设置只对单个标签页生效，新开的标签页要在打开网址前重新设置
+    """
+    if blocked_urls:
+        tab.set.blocked_urls(blocked_urls)
+
+
+class SessionStore:
+    """
+    登录成功后的 Cookie 和 dashboard 地址，保存在程序目录的 session_state.json 里
+    浏览器退出时会丢掉没有过期时间的会话 Cookie，所以单独存一份，下次启动时再写回浏览器
+    """
+
+    def __init__(self, config):
+        self.path = os.path.join(get_base_path(), SESSION_FILE)
+        self.max_age = float(config.get('session_max_age_hours', 12)) * 3600
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log(f"读取会话文件失败: {e}")
+            return None
+        if time.time() - state.get('saved_at', 0) > self.max_age:
+            log("保存的会话已超过有效期，不再尝试复用")
+            self.clear()
+            return None
+        return state
+
+    def save(self, page):
+        try:
+            state = {'url': page.url, 'cookies': page.cookies(all_info=True), 'saved_at': time.time()}
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log(f"保存会话失败: {e}")
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _wait_session_checked(page, timeout, dashboard_selector=None):
+    """
+    同时等两种结果，先出现哪个就返回哪个：出现登录框或跳离 dashboard 返回 False；
+    出现 dashboard 才有的元素 (dashboard_selector)，或没配置它时页面加载完后 URL 在 dashboard 上停留 SESSION_SETTLE_SECONDS 秒，返回 True
+    timeout 秒内两者都没出现时，仍在 dashboard 上即认为有效
+    """
+    deadline = time.monotonic() + timeout
+    settled_since = None
+    while True:
+        login_input = page.ele(LOGIN_INPUT_SELECTOR, timeout=0)
+        if login_input and login_input.states.is_displayed:
+            return False
+        if 'dashboard' not in page.url:
+            return False
+        now = time.monotonic()
+        if dashboard_selector:
+            ele = page.ele(dashboard_selector, timeout=0)
+            if ele and ele.states.is_displayed:
+                return True
+        elif page.states.ready_state == 'complete':
+            settled_since = settled_since or now
+            if now - settled_since >= SESSION_SETTLE_SECONDS:
+                return True
+        else:
+            settled_since = None
+        if now >= deadline:
+            return True
+        time.sleep(0.1)
+
+
+def try_resume_session(page, config, store):
+    """
+    用上次保存的 Cookie 打开 dashboard，仍处于登录状态返回 True
+    判断方式见 _wait_session_checked，最多等 session_check_timeout_seconds 秒，结果一确定就返回
+    """
+    state = store.load()
+    if not state or 'dashboard' not in state.get('url', ''):
+        return False
+
+    log("尝试复用上次的登录会话...")
+    try:
+        if state.get('cookies'):
+            page.set.cookies(state['cookies'])
+        page.get(state['url'])
+        timeout = float(config.get('session_check_timeout_seconds', 5))
+        if not _wait_session_checked(page, timeout, config.get('session_dashboard_selector')):
+            log("上次的会话已失效，重新登录")
+            store.clear()
+            # 清掉失效的 Cookie，避免干扰重新登录
+            page.set.cookies.clear()
+            return False
+    except Exception as e:
+        log(f"复用会话失败: {e}")
+        store.clear()
+        return False
+
+    log("会话仍有效，跳过登录和二次验证")
+    return True
+
+
+class BrowserWatchdog:
+    """
+    保活期间定时采样浏览器的内存和 CPU，把变化趋势写进日志；超出预算时重建标签页 (新开一个标签页打开 dashboard，再关掉旧的)，
+    释放长时间刷新积累下来的渲染进程内存。保活要通过 tab 属性拿当前标签页，重建后它会换成新标签页
+    两次重建至少间隔 recycle_min_interval 秒；连续重建 recycle_max_consecutive 次仍超预算就不再重建，直到回到预算内
+    装了 psutil 时统计浏览器主进程及全部子进程的 RSS 和 CPU；没装时用 CDP 读取页面的 JS 堆大小代替内存，不统计 CPU
+    check() 要在浏览器线程里调用
+    """
+
+    def __init__(self, page, memory_budget_mb=0, cpu_budget_percent=0, cpu_budget_samples=3,
+                 recycle_min_interval=600, recycle_max_consecutive=3, blocked_urls=None):
+        # page 是 create_page 返回的浏览器对象，用来开关标签页、找浏览器进程；tab 是保活当前使用的标签页
+        self.page = page
+        self.tab = page
+        self.memory_budget_mb = memory_budget_mb
+        self.cpu_budget_percent = cpu_budget_percent
+        # CPU 连续这么多次超预算才重建，避免刷新瞬间的峰值触发
+        self.cpu_budget_samples = cpu_budget_samples
+        self.recycle_min_interval = recycle_min_interval
+        self.recycle_max_consecutive = recycle_max_consecutive
+        # 重建出的新标签页同样要屏蔽这些网址
+        self.blocked_urls = blocked_urls
+        self._cpu_strikes = 0
+        self._first_mb = None
+        self._last_cpu = None
+        self._perf_enabled = False
+        self._last_recycle = None
+        # 上次回到预算内之后已经重建的次数
+        self._consecutive_recycles = 0
+        self._gave_up = False
+        try:
+            import psutil
+            self._psutil = psutil
+        except ImportError:
+            self._psutil = None
+            log("[资源] 未安装 psutil，只统计页面 JS 堆大小，不统计 CPU")
+
+    @classmethod
+    def from_config(cls, page, config):
+        return cls(
+            page,
+            memory_budget_mb=float(config.get('browser_memory_budget_mb', 0)),
+            cpu_budget_percent=float(config.get('browser_cpu_budget_percent', 0)),
+            recycle_min_interval=float(config.get('browser_recycle_min_interval_minutes', 10)) * 60,
+            recycle_max_consecutive=int(config.get('browser_recycle_max_consecutive', 3)),
+            blocked_urls=config.get('browser_block_urls'),
+        )
+
+    def _browser_processes(self):
+        pid = getattr(self.page, 'process_id', None) or getattr(getattr(self.page, 'browser', None), 'process_id', None)
+        if not pid:
+            return []
+        try:
+            root = self._psutil.Process(pid)
+            return [root] + root.children(recursive=True)
+        except self._psutil.Error:
+            return []
+
+    def sample(self):
+        """
+        采样一次，返回 (内存 MB, CPU 百分比)；CPU 未知时为 None
+        """
+        if self._psutil is None:
+            if not self._perf_enabled:
+                self.tab.run_cdp('Performance.enable')
+                self._perf_enabled = True
+            metrics = self.tab.run_cdp('Performance.getMetrics').get('metrics', [])
+            heap = next((m['value'] for m in metrics if m['name'] == 'JSHeapUsedSize'), 0)
+            return heap / 1024 / 1024, None
+
+        rss = 0
+        cpu_time = 0.0
+        for process in self._browser_processes():
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    times = process.cpu_times()
+                    cpu_time += times.user + times.system
+            except self._psutil.Error:
+                # 采样期间退出的子进程
+                continue
+        now = time.monotonic()
+        cpu_percent = None
+        if self._last_cpu is not None:
+            last_time, last_now = self._last_cpu
+            # 子进程退出会让累计时间变小，按 0 计
+            cpu_percent = max(0.0, cpu_time - last_time) / max(now - last_now, 1e-6) * 100
+        self._last_cpu = (cpu_time, now)
+        return rss / 1024 / 1024, cpu_percent
+
+    def check(self):
+        """
+        采样并记录趋势，超出预算时重建标签页，返回是否重建
+        """
+        try:
+            memory_mb, cpu_percent = self.sample()
+        except Exception as e:
+            log(f"[资源] 采样失败: {e}")
+            return False
+        if self._first_mb is None:
+            self._first_mb = memory_mb
+
+        BROWSER_MEMORY_BYTES.set(int(memory_mb * 1024 * 1024))
+        values = {'memory_mb': round(memory_mb, 1)}
+        cpu_text = ''
+        if cpu_percent is not None:
+            BROWSER_CPU_PERCENT.set(round(cpu_percent, 1))
+            values['cpu_percent'] = round(cpu_percent, 1)
+            cpu_text = f"，CPU {cpu_percent:.0f}%"
+        tracing.counter('浏览器资源', **values)
+        log(f"[资源] 浏览器内存 {memory_mb:.0f} MB (较保活开始或上次重建 {memory_mb - self._first_mb:+.0f} MB){cpu_text}")
+
+        reason = None
+        if self.memory_budget_mb and memory_mb > self.memory_budget_mb:
+            reason = f"内存 {memory_mb:.0f} MB 超过预算 {self.memory_budget_mb:.0f} MB"
+        if self.cpu_budget_percent and cpu_percent is not None:
+            self._cpu_strikes = self._cpu_strikes + 1 if cpu_percent > self.cpu_budget_percent else 0
+            if self._cpu_strikes >= self.cpu_budget_samples:
+                reason = f"CPU 连续 {self._cpu_strikes} 次超过 {self.cpu_budget_percent:.0f}%"
+        if reason is None:
+            self._consecutive_recycles = 0
+            self._gave_up = False
+            return False
+
+        if self.recycle_max_consecutive and self._consecutive_recycles >= self.recycle_max_consecutive:
+            if not self._gave_up:
+                self._gave_up = True
+                log(f"[资源] {reason}，但已连续重建 {self._consecutive_recycles} 次仍超预算，回到预算内之前不再重建")
+            return False
+        if self._last_recycle is not None and time.monotonic() - self._last_recycle < self.recycle_min_interval:
+            wait = self.recycle_min_interval - (time.monotonic() - self._last_recycle)
+            log(f"[资源] {reason}，距上次重建不足 {self.recycle_min_interval / 60:g} 分钟，{wait:.0f} 秒后再考虑重建")
+            return False
+        return self.recycle(reason)
+
+    def recycle(self, reason):
+        old_tab = self.tab
+        url = old_tab.url
+        if 'dashboard' not in url:
+            return False
+        log(f"[资源] {reason}，重建标签页")
+        BROWSER_RECYCLES.inc()
+        self._last_recycle = time.monotonic()
+        self._consecutive_recycles += 1
+        with tracing.span('重建标签页', reason=reason):
+            # 先在新标签页里打开 dashboard 再关旧的，浏览器始终有标签页，Cookie 在同一个浏览器里共享；
+            # 新标签页先空着，设置好屏蔽网址再打开 dashboard
+            new_tab = self.page.new_tab()
+            apply_blocked_urls(new_tab, self.blocked_urls)
+            new_tab.get(url)
+            new_tab.wait.doc_loaded()
+            self.page.close_tabs(old_tab.tab_id)
+        self.tab = new_tab
+        # 新标签页重新计基线
+        self._first_mb = None
+        self._perf_enabled = False
+        self._cpu_strikes = 0
+        self._last_cpu = None
+        return True
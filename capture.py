@@ -0,0 +1,211 @@
+import json
+import mmap
+import queue
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+from utils import log
+
+# 抓包文件格式：
+#   文件头 MAGIC
+#   之后每条记录 = RECORD 头 + 内容
+#   RECORD: 时间戳(秒, float64) 连接号(uint32) 方向(uint8) 操作码(int8) 原始长度(uint32) 记录长度(uint32)
+#   内容过长或被压缩时只记录原始长度，记录长度为 0
+MAGIC = b'UKCAP1\n'
+RECORD = struct.Struct('<dIBbII')
+
+DIRECTION_UP = 0
+DIRECTION_DOWN = 1
+
+DEFAULT_REDACT_KEYS = ('pin', 'password', 'passwd', 'pwd')
+REDACTED = '***'
+
+CaptureRecord = namedtuple('CaptureRecord', ['timestamp', 'conn_id', 'direction', 'opcode', 'length', 'payload'])
+
+
+class Redactor:
+    """
+    脱敏：JSON 里名字是口令类的字段 (pin、userPin、ukey_pin 这类，不包括 ping、shipping) 整个值替换掉，
+    值恰好等于配置里敏感值 (口令、密码) 的字符串也替换掉；不是 JSON 的报文只替换前后不挨着字母数字的敏感值，
+    不会把序列号、base64 签名里碰巧相同的一段数字改坏
+    """
+
+    def __init__(self, secrets=(), keys=DEFAULT_REDACT_KEYS):
+        self.secrets = {s for s in secrets if s}
+        self.keys = tuple(k.lower() for k in keys if k)
+        self._probes = [s.encode('utf-8') for s in self.secrets] + [k.encode('utf-8') for k in self.keys]
+        alternatives = '|'.join(re.escape(s) for s in sorted(self.secrets, key=len, reverse=True))
+        # 报文里的敏感值：前后是字母数字或 base64 字符时不算，JSON 字符串值和非 JSON 报文都按这个规则替换
+        pattern = r'(?<![0-9A-Za-z+/_])(?:' + alternatives + r')(?![0-9A-Za-z+/=_])'
+        self._secret_re = re.compile(pattern.encode('utf-8')) if alternatives else None
+        self._secret_text_re = re.compile(pattern) if alternatives else None
+        # 非 JSON 报文里 "pin": "值" 这类字段，只替换字符串或标量值，键名整体匹配后再判断
+        self._field_re = re.compile(rb'"((?:[^"\\]|\\.)*)"(\s*:\s*)("(?:[^"\\]|\\.)*"|[^,}\]\s\[{]+)')
+
+    def is_secret_key(self, key):
+        lower = key.lower()
+        for k in self.keys:
+            if lower == k or lower.endswith('_' + k) or lower.endswith('-' + k):
+                return True
+            # 驼峰命名：userPin、newPassword
+            if len(key) > len(k) and lower.endswith(k) and key[-len(k)].isupper() and key[-len(k) - 1].islower():
+                return True
+        return False
+
+    def __call__(self, payload):
+        if not payload:
+            return payload
+        payload = bytes(payload)
+        # 绝大多数报文里既没有敏感值也没有口令类的字段名，不做解析
+        lower = payload.lower()
+        if not any(probe.lower() in lower for probe in self._probes):
+            return payload
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return self._redact_text(payload)
+        redacted, changed = self._redact_json(data)
+        if not changed:
+            return payload
+        return json.dumps(redacted, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def _redact_json(self, value):
+        if isinstance(value, dict):
+            changed = False
+            result = {}
+            for key, item in value.items():
+                if self.is_secret_key(key):
+                    result[key] = REDACTED
+                    changed = True
+                else:
+                    result[key], item_changed = self._redact_json(item)
+                    changed = changed or item_changed
+            return result, changed
+        if isinstance(value, list):
+            items = [self._redact_json(item) for item in value]
+            return [item for item, _ in items], any(changed for _, changed in items)
+        if isinstance(value, str) and self._secret_text_re is not None:
+            redacted = self._secret_text_re.sub(REDACTED, value)
+            return redacted, redacted != value
+        return value, False
+
+    def _redact_text(self, payload):
+        def replace_field(m):
+            try:
+                key = json.loads(b'"' + m.group(1) + b'"')
+            except ValueError:
+                return m.group(0)
+            if not self.is_secret_key(key):
+                return m.group(0)
+            return b'"' + m.group(1) + b'"' + m.group(2) + json.dumps(REDACTED).encode('utf-8')
+
+        payload = self._field_re.sub(replace_field, payload)
+        if self._secret_re is not None:
+            payload = self._secret_re.sub(REDACTED.encode('utf-8'), payload)
+        return payload
+
+
+class CaptureWriter:
+    """
+    抓包记录器：只追加写，写盘在后台线程完成，不阻塞代理的事件循环
+    """
+
+    def __init__(self, path, redactor=None):
+        self.path = path
+        self.redactor = redactor
+        self._queue = queue.SimpleQueue()
+        self._next_conn_id = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._thread = threading.Thread(target=self._run, name='capture-writer', daemon=True)
+        self._thread.start()
+        log(f"[Proxy] 抓包已开启，写入 {path}")
+
+    def new_conn_id(self):
+        with self._lock:
+            self._next_conn_id += 1
+            return self._next_conn_id
+
+    def record(self, conn_id, direction, opcode, length, payload):
+        if payload is not None and self.redactor is not None:
+            payload = self.redactor(payload)
+        payload = bytes(payload) if payload else b''
+        self._queue.put(RECORD.pack(time.time(), conn_id, direction, opcode, length, len(payload)) + payload)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(5)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 500:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = None in batch
+            try:
+                self._file.write(b''.join(item for item in batch if item is not None))
+                self._file.flush()
+            except Exception as e:
+                log(f"[Proxy] 写入抓包文件失败: {e}")
+            if stop:
+                self._file.close()
+                return
+
+
+class CaptureReader:
+    """
+    用 mmap 读取抓包文件，不整体读入内存
+    迭代得到的 CaptureRecord.payload 是指向文件映射的 memoryview，close() 之后不可再用
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法映射
+            self._file.close()
+            raise ValueError(f"{path} 不是抓包文件")
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} 不是抓包文件")
+        self._view = memoryview(self._mm)
+
+    def __iter__(self):
+        pos = len(MAGIC)
+        end = len(self._mm)
+        while pos + RECORD.size <= end:
+            timestamp, conn_id, direction, opcode, length, stored = RECORD.unpack_from(self._mm, pos)
+            pos += RECORD.size
+            if pos + stored > end:
+                # 最后一条没写完 (例如进程被强制结束)
+                break
+            yield CaptureRecord(timestamp, conn_id, direction, opcode, length, self._view[pos:pos + stored])
+            pos += stored
+
+    def close(self):
+        view = getattr(self, '_view', None)
+        if view is not None:
+            view.release()
+            self._view = None
+        try:
+            self._mm.close()
+        except BufferError:
+            # 调用方还持有 payload 的切片，映射随对象回收时再释放
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
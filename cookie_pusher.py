@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import tracing
+from utils import log, get_base_path
+from metrics import Counter, Histogram
+
+COOKIE_PUSH_TOTAL = Counter('cookie_push_total', 'Cookie 推送次数，按结果区分', ['result'])
+COOKIE_PUSH_SECONDS = Histogram('cookie_push_seconds', '单次 Cookie 推送请求的耗时')
+
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+SPOOL_FILE = 'cookie_spool.json'
+
+_pusher = None
+_pusher_lock = threading.Lock()
+
+
+def cookie_fingerprint(cookies):
+    return hashlib.sha256(json.dumps(cookies, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def send_cookies_to_server(data, server_url, session):
+    """
+    将 Cookie 发送到远程服务器，成功返回 True
+    """
+    try:
+        # ---------------------------------------------------------
+        # 1. 数据处理：将字典/列表转换为 "key=value; key=value" 字符串
+        # ---------------------------------------------------------
+
+        # 如果 page_cookies 是列表 (as_dict=False)，先转成字典便于处理
+        if isinstance(data['cookies'], list):
+            cookie_dict = {item['name']: item['value'] for item in data['cookies']}
+        else:
+            cookie_dict = data['cookies']
+        cookie_string = "; ".join([f"{key}={value}" for key, value in cookie_dict.items()])
+
+        # ---------------------------------------------------------
+        # 2. 构造请求：
+        # ---------------------------------------------------------
+        headers = {
+            "xcookie": cookie_string,
+            "Content-Type": "application/json",
+        }
+
+        log(f"正在发送 Cookie 到服务器: {server_url}")
+        # 发送 POST 请求 (复用 session 里的长连接)
+        start = time.perf_counter()
+        response = session.post(server_url, headers=headers, json=data['payload'], timeout=10)
+        COOKIE_PUSH_SECONDS.observe(time.perf_counter() - start)
+        if response.status_code == 200:
+            res_json = response.json()
+            log("接口响应成功: " + str(res_json))
+            return True
+        log(f"接口报错，状态码: {response.status_code}, 内容: {response.text}")
+    except Exception as e:
+        log(f"发送请求时出错: {e}")
+    return False
+
+
+class CookiePusher:
+    """
+    后台推送 Cookie：
+    - 复用同一个 requests.Session，推送走长连接
+    - Cookie 没变就不推送
+    - 在后台线程发送，推送服务器慢或不可用时不阻塞保活循环；失败按退避时间重试
+    - 待推送的内容先写进磁盘上的 spool 文件，推送成功后删除，进程退出后下次启动还会补推
+    """
+
+    def __init__(self, server_url, spool_path=None, max_backoff=300, spool_max_age=3600):
+        self.server_url = server_url
+        self.spool_path = spool_path or os.path.join(get_base_path(), SPOOL_FILE)
+        self.max_backoff = max_backoff
+        # spool 里超过这么久的 Cookie 多半已失效，不再补推
+        self.spool_max_age = spool_max_age
+        self._session = None
+        self._cond = threading.Condition()
+        self._pending = None
+        self._sending = False
+        self._last_pushed = None
+        self._load_spool()
+        self._thread = threading.Thread(target=self._run, name='cookie-pusher', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get('push_server_url'),
+            max_backoff=float(config.get('cookie_push_max_backoff_seconds', 300)),
+            spool_max_age=float(config.get('cookie_spool_max_age_minutes', 60)) * 60,
+        )
+
+    def push(self, cookies, payload):
+        """
+        提交一组 Cookie，立即返回；和上次推送成功 (或正在排队) 的一样时跳过
+        """
+        fingerprint = cookie_fingerprint(cookies)
+        with self._cond:
+            latest = self._pending['fingerprint'] if self._pending else self._last_pushed
+            if fingerprint == latest:
+                COOKIE_PUSH_TOTAL.labels('unchanged').inc()
+                log("Cookie 未变化，跳过推送")
+                return
+            # 还没发出去的旧 Cookie 直接被新的替换
+            self._pending = {'fingerprint': fingerprint, 'cookies': cookies, 'payload': payload,
+                             'created_at': time.time()}
+            self._write_spool(self._pending)
+            self._cond.notify_all()
+
+    def flush(self, timeout=15):
+        """
+        等待排队中的 Cookie 推送完成，返回是否已全部推送
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending is not None or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log("Cookie 仍未推送成功，保留在 spool 中下次继续推送")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        backoff = 1
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                item = self._pending
+                self._sending = True
+
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+                self._session.headers['User-Agent'] = USER_AGENT
+                # 获取 CA 根证书的路径
+                self._session.verify = os.path.join("certs", "ca.crt")
+
+            with tracing.span('推送 Cookie'):
+                ok = send_cookies_to_server(item, self.server_url, self._session)
+            COOKIE_PUSH_TOTAL.labels('success' if ok else 'failure').inc()
+
+            with self._cond:
+                self._sending = False
+                if ok:
+                    self._last_pushed = item['fingerprint']
+                    if self._pending is item:
+                        self._pending = None
+                        self._remove_spool()
+                    backoff = 1
+                self._cond.notify_all()
+                if ok or self._pending is not item:
+                    continue
+                log(f"Cookie 推送失败，{backoff:.0f} 秒后重试")
+                # 等待期间来了新的 Cookie 就立即改推新的
+                self._cond.wait_for(lambda: self._pending is not item, backoff)
+                if self._pending is not item:
+                    backoff = 1
+                else:
+                    backoff = min(backoff * 2, self.max_backoff)
+
+    # ------------------------------------------------------------------
+    # spool 文件
+    # ------------------------------------------------------------------
+
+    def _load_spool(self):
+        try:
+            with open(self.spool_path, 'r', encoding='utf-8') as f:
+                item = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log(f"读取 Cookie spool 失败: {e}")
+            self._remove_spool()
+            return
+        if time.time() - item.get('created_at', 0) > self.spool_max_age:
+            log("spool 中的 Cookie 已过期，丢弃")
+            self._remove_spool()
+            return
+        log("发现上次未推送成功的 Cookie，稍后补推")
+        self._pending = item
+
+    def _write_spool(self, item):
+        tmp_path = self.spool_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(item, f, ensure_ascii=False)
+            os.replace(tmp_path, self.spool_path)
+        except OSError as e:
+            log(f"写入 Cookie spool 失败: {e}")
+
+    def _remove_spool(self):
+        try:
+            os.remove(self.spool_path)
+        except OSError:
+            pass
+
+
+def get_cookie_pusher(config):
+    """
+    进程内共用一个推送器 (常驻服务模式下多次登录之间复用同一个长连接)，未配置 push_server_url 时返回 None
+    """
+    global _pusher
+    if not config.get('push_server_url'):
+        return None
+    with _pusher_lock:
+        if _pusher is None:
+            _pusher = CookiePusher.from_config(config)
+        return _pusher
@@ -0,0 +1,78 @@
+import builtins
+import importlib.util
+import sys
+import threading
+import time
+from utils import log
+
+_original_import = builtins.__import__
+_local = threading.local()
+_lock = threading.Lock()
+_started = None
+# 模块名 -> [首次导入时刻 (相对开启时), 含子模块的总耗时, 自身耗时, 导入线程名, 是否为顶层导入]
+_records = {}
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level:
+        try:
+            full_name = importlib.util.resolve_name('.' * level + name, (globals or {}).get('__package__'))
+        except (ImportError, ValueError):
+            full_name = name
+    else:
+        full_name = name
+    if full_name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    begin = time.perf_counter()
+    # 子模块的耗时累加到这里，用来算自身耗时
+    stack.append(0.0)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        children = stack.pop()
+        elapsed = time.perf_counter() - begin
+        if stack:
+            stack[-1] += elapsed
+        with _lock:
+            # 导入失败的模块不计
+            if full_name in sys.modules and full_name not in _records:
+                _records[full_name] = [begin - _started, elapsed, elapsed - children,
+                                       threading.current_thread().name, not stack]
+
+
+def enable():
+    """
+    开始统计此后每个模块的导入耗时 (已导入过的模块不计)
+    """
+    global _started
+    if builtins.__import__ is _timed_import:
+        return
+    _started = time.perf_counter()
+    builtins.__import__ = _timed_import
+
+
+def disable():
+    builtins.__import__ = _original_import
+
+
+def report(top=20):
+    """
+    把导入耗时写进日志：顶层导入按总耗时列出 (对应代码里的一条 import)，再按自身耗时列出最慢的模块
+    """
+    with _lock:
+        records = dict(_records)
+    if not records:
+        return
+
+    total = sum(r[1] for r in records.values() if r[4])
+    log(f"[启动分析] 共导入 {len(records)} 个模块，顶层导入合计 {total * 1000:.1f} ms")
+    for name, (at, inclusive, _, thread, _) in sorted(
+            ((k, v) for k, v in records.items() if v[4]), key=lambda item: item[1][1], reverse=True)[:top]:
+        log(f"[启动分析]   +{at:7.3f}s  {inclusive * 1000:8.1f} ms  {name}  ({thread})")
+    log(f"[启动分析] 自身耗时最长的 {top} 个模块:")
+    for name, (_, _, own, _, _) in sorted(records.items(), key=lambda item: item[1][2], reverse=True)[:top]:
+        log(f"[启动分析]   {own * 1000:8.1f} ms  {name}")
@@ -1,23 +1,91 @@
-import os
+import asyncio
+import concurrent.futures
+import sys
 import time
 import base64
 import io
-import requests
 from datetime import datetime, timedelta
-from types import SimpleNamespace
-from PIL import Image
-from DrissionPage import ChromiumPage
-import ddddocr
 import random
-import threading
-import wsproxy
-from mqtt_handler import MqttCodeListener
-from utils import log, load_config, get_human_tracks
+import socket
+import multiprocessing
+from contextlib import contextmanager
+import import_timer
+import tracing
+from utils import log, load_config, configure_log, get_human_tracks
 
+# DrissionPage、ddddocr、PIL、requests、wsproxy、MQTT 等较重的依赖都在用到的地方才导入，
+# 例如 ukey 模式下没出现滑块时不会加载 ddddocr，不开代理时不会加载 wsproxy 和 cryptography
 
-def solve_slider(page):
+# 各类等待的默认超时 (秒)，可在配置里用 wait_<名称>_timeout_seconds 覆盖
+WAIT_TIMEOUTS = {
+    'element': 10,        # 页面元素出现
+    'captcha': 10,        # 点击登录后，等滑块或角色选择框出现
+    'slider_result': 6,   # 滑动后等校验结果
+    'sms_resend': 70,     # 短信按钮倒计时结束、可以重新获取
+    'sms_code': 80,       # 点击发送后等 MQTT 验证码
+    'dashboard': 10,      # 提交验证后跳转到 dashboard
+}
+
+SLIDER_SELECTOR = 'css:.verify-img-out'
+ROLE_DIALOG_SELECTOR = 'css:.loginselect-dialog > .el-dialog__wrapper'
+SMS_BUTTON_READY_SELECTOR = ('xpath://button[not(contains(@class, "is-disabled")) and '
+                             './/span[contains(text(), "获取验证码") or contains(text(), "重新获取")]]')
+
+
+def wait_timeout(config, name):
+    return float((config or {}).get(f'wait_{name}_timeout_seconds', WAIT_TIMEOUTS[name]))
+
+
+def wait_until(condition, timeout, interval=0.1):
+    """
+    轮询 condition 直到返回真值或超时，返回最后一次的结果
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if result or time.monotonic() >= deadline:
+            return result
+        time.sleep(interval)
+
+
+def wait_any_displayed(page, selectors, timeout):
+    """
+    等待几个元素中任意一个可见，返回先可见的那个选择器，超时返回 None
+    """
+    def check():
+        for selector in selectors:
+            ele = page.ele(selector, timeout=0)
+            if ele and ele.states.is_displayed:
+                return selector
+        return None
+    return wait_until(check, timeout)
+
+
+def port_listening(port):
+    try:
+        with socket.create_connection(('127.0.0.1', int(port)), timeout=0.2):
+            return True
+    except (OSError, TypeError, ValueError):
+        return False
+
+
+@contextmanager
+def timed_step(name, **args):
+    # 记录每个步骤的耗时，方便看出时间花在哪；开启追踪时同时记入追踪文件
+    start = time.perf_counter()
+    try:
+        with tracing.span(name, **args):
+            yield
+    finally:
+        log(f"[耗时] {name}: {time.perf_counter() - start:.2f} 秒")
+
+
+def solve_slider(page, config=None):
     log("开始处理滑动验证码...")
     try:
+        import ddddocr
+        from PIL import Image
+
         # 1. 定位元素
         bg_ele = page.ele('css:.verify-img-out img', timeout=5)
         block_ele = page.ele('css:.verify-sub-block img', timeout=5)
@@ -32,7 +100,8 @@ def solve_slider(page):
             if ',' in src: src = src.split(',')[1]
             return base64.b64decode(src)
 
-        bg_bytes = get_bytes(bg_ele.attr('src'))
+        bg_src = bg_ele.attr('src')
+        bg_bytes = get_bytes(bg_src)
         block_bytes = get_bytes(block_ele.attr('src'))
 
         # 3. 识别缺口
@@ -57,11 +126,9 @@ def solve_slider(page):
         time.sleep(random.uniform(0.2, 0.4))
         page.actions.release()
 
-        target_selector = 'css:.loginselect-dialog > .el-dialog__wrapper'
-
         # 使用 wait.ele_displayed 等待元素变得可见
         # timeout 设为 3-6 秒比较合适，因为滑动成功后后端返回结果需要一点时间
-        is_success = page.wait.ele_displayed(target_selector, timeout=6)
+        is_success = page.wait.ele_displayed(ROLE_DIALOG_SELECTOR, timeout=wait_timeout(config, 'slider_result'))
 
         if is_success:
             log("滑动校验成功：角色选择对话框已显示。")
@@ -71,11 +138,17 @@ def solve_slider(page):
 
             # 失败后通常验证码会自动刷新，如果没有刷新，手动点一下刷新按钮
             try:
-                refresh_btn = page.ele('css:.verify-refresh', timeout=1)
-                if refresh_btn:
-                    log("点击刷新验证码，准备重试...")
-                    refresh_btn.click()
-                    time.sleep(1)
+                def refreshed():
+                    ele = page.ele('css:.verify-img-out img', timeout=0)
+                    return bool(ele) and ele.attr('src') != bg_src
+
+                if not wait_until(refreshed, 1):
+                    refresh_btn = page.ele('css:.verify-refresh', timeout=1)
+                    if refresh_btn:
+                        log("点击刷新验证码，准备重试...")
+                        refresh_btn.click()
+                        # 等新图片加载出来再重试
+                        wait_until(refreshed, wait_timeout(config, 'element'))
             except:
                 pass
 
@@ -86,25 +159,35 @@ def solve_slider(page):
         return False
 
 
-def init_browser_and_login(config):
-    # 初始化并完成初步登录及滑块验证码
-    page = ChromiumPage()
-    page.get(config['url'])
-
-    log("输入账号密码...")
-    time.sleep(2)
-    page.ele('css:input.el-input__inner[placeholder="请输入账号"]').input(config['username'], by_js=False)
-    time.sleep(1)
-    page.ele('css:input.el-input__inner[placeholder="请输入密码"]').input(config['password'], by_js=False)
-    time.sleep(1)
-    page.ele('css:button.login-elbutton').click()
+def init_browser_and_login(config, page=None):
+    # 初始化并完成初步登录及滑块验证码；page 为复用会话失败后留下的浏览器时直接在上面登录
+    from browser_session import create_page
+    element_timeout = wait_timeout(config, 'element')
+    if page is None:
+        with timed_step("启动浏览器"):
+            page = create_page(config)
+    with timed_step("打开登录页"):
+        page.get(config['url'])
+
+    with timed_step("输入账号密码"):
+        log("输入账号密码...")
+        # 输入框出现即可输入，不再固定等待
+        page.wait.ele_displayed('css:input.el-input__inner[placeholder="请输入账号"]', timeout=element_timeout)
+        page.ele('css:input.el-input__inner[placeholder="请输入账号"]').input(config['username'], by_js=False)
+        page.ele('css:input.el-input__inner[placeholder="请输入密码"]', timeout=element_timeout).input(
+            config['password'], by_js=False)
+        page.ele('css:button.login-elbutton', timeout=element_timeout).click()
 
     max_retries = 10
     for i in range(max_retries):
-        time.sleep(2)
-        if page.ele('css:.verify-img-out'):
+        # 点击登录后要么弹出滑块，要么直接出现角色选择框
+        with timed_step("等待滑块或下一步"):
+            shown = wait_any_displayed(page, [SLIDER_SELECTOR, ROLE_DIALOG_SELECTOR], wait_timeout(config, 'captcha'))
+        if shown == SLIDER_SELECTOR:
             log(f"检测到验证码，第 {i+1} 次尝试...")
-            if solve_slider(page):
+            with timed_step(f"滑块验证 第 {i + 1} 次"):
+                solved = solve_slider(page, config)
+            if solved:
                 break # 成功则跳出循环
             else:
                 if i == max_retries - 1:
@@ -122,113 +205,121 @@ def init_browser_and_login(config):
 def handle_verification(page, config, mqtt_listener):
     mode = config.get('verification_mode', 'ukey')
     log(f"当前验证模式: {mode}")
-    sms_tab = page.ele('#tab-SMS')
-    ukey_tab = page.ele('#tab-USB_KEY')
+    element_timeout = wait_timeout(config, 'element')
+    sms_tab = page.ele('#tab-SMS', timeout=element_timeout)
+    ukey_tab = page.ele('#tab-USB_KEY', timeout=element_timeout)
 
     if mode == 'ukey':
-        # 点击证书验证tab下的验证按钮
-        uk_verify_btn = page.ele('css:.ukey_div button')
-        uk_verify_btn.click()
-        time.sleep(2)
-
-        # 输入 PIN
-        uk_input = page.ele('css:input.el-input__inner[placeholder="请输入Ukey口令"]')
-        uk_input.input(config['ukey_pin'])
-
-        # 点击确定
-        dialog_container = uk_input.parent('css:.el-dialog')
-        dialog_container.ele(
-            'xpath:.//div[contains(@class, "el-dialog__footer")]//button[contains(., "确 定")]').click()
-        log("Ukey 验证表单已提交")
+        with timed_step("Ukey 验证"):
+            # 点击证书验证tab下的验证按钮
+            uk_verify_btn = page.ele('css:.ukey_div button')
+            uk_verify_btn.click()
+
+            # 输入 PIN (等口令框弹出)
+            pin_selector = 'css:input.el-input__inner[placeholder="请输入Ukey口令"]'
+            page.wait.ele_displayed(pin_selector, timeout=element_timeout)
+            uk_input = page.ele(pin_selector)
+            uk_input.input(config['ukey_pin'])
+
+            # 点击确定
+            dialog_container = uk_input.parent('css:.el-dialog')
+            dialog_container.ele(
+                'xpath:.//div[contains(@class, "el-dialog__footer")]//button[contains(., "确 定")]').click()
+            log("Ukey 验证表单已提交")
 
     elif mode == 'sms':
+        send_btn_selector = ('xpath://button[.//span[contains(text(), "获取验证码") or contains(text(), "重新获取") '
+                             'or contains(text(), "s")]]')
         sms_tab.click()
-        time.sleep(1)
+        # 等短信验证的按钮出现
+        page.wait.ele_displayed(send_btn_selector, timeout=element_timeout)
 
         sms_success = False
         max_sms_attempts = 3
 
         for attempt in range(max_sms_attempts):
-            log(f"--- 短信验证尝试 第 {attempt + 1} 次 ---")
-            mqtt_listener.clear_code()
-            send_code_btn = page.ele(
-                'xpath://button[.//span[contains(text(), "获取验证码") or contains(text(), "重新获取") or contains(text(), "s")]]')
-            if not send_code_btn:
-                log("未找到获取验证码按钮")
-                # 找不到来回切换下tab
-                ukey_tab.click()
-                time.sleep(0.5)
-                sms_tab.click()
-                time.sleep(3)
-                continue
-
-            # 如果按钮还处于禁用状态（例如倒计时还没跑完），则等待
-            if 'is-disabled' in send_code_btn.attr('class'):
-                log("按钮仍在倒计时/禁用状态，等待恢复...")
-                # 动态等待按钮文本恢复为“重新获取”或“获取验证码”，最多等 10 秒（因为 MQTT 已经等了 80 秒）
-                # wait.ele_displayed 会检测元素是否可见/可用
-                is_ready = page.wait.ele_displayed(
-                    'xpath://button[not(contains(@class, "is-disabled")) and .//span[contains(text(), "重新获取")]]',
-                    timeout=10)
-                if not is_ready:
-                    log("按钮恢复超时，尝试来回切换tab")
+            with timed_step(f"短信验证 第 {attempt + 1} 次"):
+                log(f"--- 短信验证尝试 第 {attempt + 1} 次 ---")
+                send_code_btn = page.ele(send_btn_selector)
+                if not send_code_btn:
+                    log("未找到获取验证码按钮")
+                    # 找不到来回切换下tab，等按钮重新出现
                     ukey_tab.click()
-                    time.sleep(0.5)
                     sms_tab.click()
-                    time.sleep(70)
+                    page.wait.ele_displayed(send_btn_selector, timeout=element_timeout)
                     continue
 
-            log(f"点击发送验证码: {send_code_btn.text.strip()}")
-            send_code_btn.click()
-
-            # 阻塞等待 MQTT 验证码 (80秒)
-            code = mqtt_listener.get_code(timeout=80)
-
-            if code:
-                log(f"收到验证码: {code}")
-
-                # 逻辑：按钮 -> 父div -> 该div的兄弟节点中的input（且placeholder为短信验证码）
-                # 我们先跳到父div，再跳到共同的父容器，然后查找符合条件的input
-                input_ele = send_code_btn.parent('tag:div').parent().ele('css:input[placeholder="短信验证码"]')
-
-                if input_ele:
-                    log("成功定位到短信验证码输入框")
-                    # 确保元素可见并点击
-                    input_ele.click()
-                    # 先用 JS 清空，再模拟输入
-                    input_ele.run_js('this.value=""')
-                    time.sleep(0.5)
-                    # 模拟真实输入
-                    input_ele.input(code, by_js=False)
-                    log(f"已填入验证码: {code}")
-                    time.sleep(1)
-
-                    # 点击“验证”按钮（注意按钮文本可能有空格）
-                    confirm_btn = page.ele('xpath://button[.//span[contains(text(), "验 证")]]')
-                    if confirm_btn:
-                        confirm_btn.click()
-
-                    # 验证是否登录成功
-                    try:
-                        # 等待 URL 变化，出现 dashboard 即为成功
-                        if page.wait.url_change(text='dashboard', timeout=10):
-                            log("短信验证成功，已进入系统")
-                            sms_success = True
-                            break
-                        else:
-                            log(f"登录报错,等待70秒后再试")
-                            time.sleep(70)
-                    except:
-                        log("输入验证码后跳转超时")
-                else:
-                    log("未能通过相对路径定位到输入框")
+                # 如果按钮还处于禁用状态（例如倒计时还没跑完），则等待
+                if 'is-disabled' in send_code_btn.attr('class'):
+                    log("按钮仍在倒计时/禁用状态，等待恢复...")
+                    # 动态等待按钮文本恢复为“重新获取”或“获取验证码”，倒计时一结束就继续
+                    # wait.ele_displayed 会检测元素是否可见/可用
+                    is_ready = page.wait.ele_displayed(SMS_BUTTON_READY_SELECTOR,
+                                                       timeout=wait_timeout(config, 'sms_resend'))
+                    if not is_ready:
+                        log("按钮恢复超时，尝试来回切换tab")
+                        ukey_tab.click()
+                        sms_tab.click()
+                        page.wait.ele_displayed(send_btn_selector, timeout=element_timeout)
+                        continue
+                    send_code_btn = page.ele(SMS_BUTTON_READY_SELECTOR)
+
+                log(f"点击发送验证码: {send_code_btn.text.strip()}")
+                # 清空旧验证码并记下点击时间，早于这次点击收到的验证码会被丢弃
+                mqtt_listener.mark_code_requested()
+                send_code_btn.click()
+
+                # 阻塞等待 MQTT 验证码 (默认80秒)，收到即返回
+                code_timeout = wait_timeout(config, 'sms_code')
+                with timed_step("等待短信验证码"):
+                    code = mqtt_listener.get_code(timeout=code_timeout)
+
+                if code:
+                    log(f"收到验证码: {code}")
+
+                    # 逻辑：按钮 -> 父div -> 该div的兄弟节点中的input（且placeholder为短信验证码）
+                    # 我们先跳到父div，再跳到共同的父容器，然后查找符合条件的input
+                    input_ele = send_code_btn.parent('tag:div').parent().ele('css:input[placeholder="短信验证码"]')
+
+                    if input_ele:
+                        log("成功定位到短信验证码输入框")
+                        # 确保元素可见并点击
+                        input_ele.click()
+                        # 先用 JS 清空，再模拟输入
+                        input_ele.run_js('this.value=""')
+                        # 模拟真实输入
+                        input_ele.input(code, by_js=False)
+                        log(f"已填入验证码: {code}")
+
+                        # 点击“验证”按钮（注意按钮文本可能有空格）
+                        confirm_btn = page.ele('xpath://button[.//span[contains(text(), "验 证")]]',
+                                               timeout=element_timeout)
+                        if confirm_btn:
+                            confirm_btn.click()
+
+                        # 验证是否登录成功
+                        try:
+                            # 等待 URL 变化，出现 dashboard 即为成功
+                            if page.wait.url_change(text='dashboard', timeout=wait_timeout(config, 'dashboard')):
+                                log("短信验证成功，已进入系统")
+                                sms_success = True
+                                break
+                            else:
+                                # 验证码作废后要等按钮倒计时结束才能重新获取，按钮一可用就重试
+                                log("登录报错，等待可以重新获取验证码后再试")
+                                page.wait.ele_displayed(SMS_BUTTON_READY_SELECTOR,
+                                                        timeout=wait_timeout(config, 'sms_resend'))
+                        except:
+                            log("输入验证码后跳转超时")
+                    else:
+                        log("未能通过相对路径定位到输入框")
 
-            else:
-                log(f"第 {attempt + 1} 次尝试：80秒内未收到 MQTT 消息")
-                # 如果这是最后一次尝试，且没收到，流程就结束了
-                if attempt < max_sms_attempts - 1:
-                    log("准备进行下一次重新发送...")
-                    # 这里不需要 sleep 太多，因为 loop 开始会重新检查按钮状态
+                else:
+                    log(f"第 {attempt + 1} 次尝试：{code_timeout:.0f}秒内未收到 MQTT 消息")
+                    # 如果这是最后一次尝试，且没收到，流程就结束了
+                    if attempt < max_sms_attempts - 1:
+                        log("准备进行下一次重新发送...")
+                        # 这里不需要 sleep 太多，因为 loop 开始会重新检查按钮状态
 
         return sms_success
 
@@ -236,156 +327,336 @@ def handle_verification(page, config, mqtt_listener):
         log("无需额外验证或未知模式")
         return True
 
-def process_cookies_and_keep_alive(page, config):
-    """步骤 7：获取 Cookie 并进行保活"""
-    remote_server_url = config.get('push_server_url')
-
-    # 1. 等待登录成功跳转
+def wait_for_dashboard(page, config):
     try:
         log("等待跳转到 dashboard...")
-        page.wait.url_change(text='dashboard', timeout=15)
+        page.wait.url_change(text='dashboard', timeout=wait_timeout(config, 'dashboard'))
         page.wait.load_start()
     except:
         log("等待跳转超时，尝试获取当前状态")
 
+
+def refresh_page(page):
+    """
+    刷新一次保活，仍在 dashboard 返回 True
+    """
+    log("执行页面刷新保活...")
+    page.refresh()
+    time.sleep(random.uniform(2, 5))
+    if 'dashboard' not in page.url:
+        log(f"检测到已掉线 (URL: {page.url})")
+        return False
+    return True
+
+
+async def process_cookies_and_keep_alive(browser, page, config, quit_browser=True):
+    """步骤 7：获取 Cookie 并进行保活"""
+    from cookie_pusher import get_cookie_pusher
+    from browser_session import BrowserWatchdog, SessionStore
+    # 后台推送，推送服务器慢或不可用时不阻塞保活
+    pusher = get_cookie_pusher(config)
+    # 保存当前会话，下次启动时先尝试复用
+    session_store = SessionStore(config) if config.get('session_reuse', True) else None
+
+    # 保活期间定时检查浏览器的内存和 CPU，超出预算时重建标签页；重建后保活改用新标签页
+    watchdog = None
+    watchdog_interval = float(config.get('browser_watchdog_interval_seconds', 60))
+    if watchdog_interval > 0:
+        watchdog = BrowserWatchdog.from_config(page, config)
+
+    def current_tab():
+        return watchdog.tab if watchdog is not None else page
+
+    # 1. 等待登录成功跳转
+    await browser.call(wait_for_dashboard, page, config, step="等待进入 dashboard")
+
     # 2. 初始 Cookie 获取与发送
     def get_and_push_cookies():
-        cookies_list = page.cookies()
+        tab = current_tab()
+        cookies_list = tab.cookies()
         cookies_dict = {item['name']: item['value'] for item in cookies_list}
-        if cookies_dict and remote_server_url:
-            data = SimpleNamespace(cookies=cookies_dict, payload={"username": config['username']})
-            send_cookies_to_server(data, remote_server_url)
+        if cookies_dict and pusher:
+            pusher.push(cookies_dict, {"username": config['username']})
+        if cookies_dict and session_store and 'dashboard' in tab.url:
+            session_store.save(tab)
         return cookies_dict
 
-    get_and_push_cookies()
+    await browser.call(get_and_push_cookies)
+
+    # 3. 保活循环 (时长和间隔每轮重新读取，热加载修改后下一轮生效)
+    keep_alive_start = datetime.now()
+
+    def keep_alive_end():
+        return keep_alive_start + timedelta(hours=config.get('keep_alive_duration_hours', 2))
 
-    # 3. 保活循环
-    keep_alive_h = config.get('keep_alive_duration_hours', 2)
-    interval_m = config.get('keep_alive_interval_minutes', 10)
-    end_time = datetime.now() + timedelta(hours=keep_alive_h)
-    log(f"开始保活，预计结束时间: {end_time.strftime('%H:%M:%S')}")
+    log(f"开始保活，预计结束时间: {keep_alive_end().strftime('%H:%M:%S')}")
+
+    watchdog_task = None
+    if watchdog is not None:
+        watchdog_task = asyncio.create_task(watch_browser(browser, watchdog, watchdog_interval))
 
     try:
-        while datetime.now() < end_time:
+        refresh_round = 0
+        while datetime.now() < keep_alive_end():
             # 计算下次刷新等待时间（带抖动）
-            sleep_sec = (interval_m * 60) + random.uniform(-60, 60)
+            sleep_sec = (config.get('keep_alive_interval_minutes', 10) * 60) + random.uniform(-60, 60)
             log(f"等待 {sleep_sec:.1f} 秒后进行下次刷新...")
-            time.sleep(max(sleep_sec, 5))
-
-            log("执行页面刷新保活...")
-            page.refresh()
-            time.sleep(random.uniform(2, 5))
+            await asyncio.sleep(max(sleep_sec, 5))
 
-            if 'dashboard' not in page.url:
-                log(f"检测到已掉线 (URL: {page.url})")
+            refresh_round += 1
+            if not await browser.call(refresh_page, current_tab(), step="保活刷新", round=refresh_round):
+                if session_store:
+                    session_store.clear()
                 break
 
             # 刷新后更新并重新发送 Cookie
-            get_and_push_cookies()
+            await browser.call(get_and_push_cookies)
 
     except Exception as e:
         log(f"保活异常: {e}")
     finally:
-        log("保活结束，关闭浏览器")
-        page.quit()
+        if watchdog_task is not None:
+            watchdog_task.cancel()
+        if pusher:
+            # 退出前尽量把最后一次 Cookie 推出去，没推成的留在 spool 里下次补推
+            await asyncio.to_thread(pusher.flush)
+        if quit_browser:
+            log("保活结束，关闭浏览器")
+            await browser.call(page.quit)
+        else:
+            log("保活结束，保留浏览器供下次登录使用")
+            await browser.call(reset_browser, current_tab(), session_store is not None)
 
-def send_cookies_to_server(data, server_url):
+
+async def watch_browser(browser, watchdog, interval):
+    while True:
+        await asyncio.sleep(interval)
+        # 和保活刷新一样在浏览器线程里执行，不会与刷新交错
+        await browser.call(watchdog.check)
+
+
+def reset_browser(page, keep_session=False):
     """
-    将 Cookie 发送到远程服务器
+    常驻服务保留浏览器时回到空白页，下次登录时直接接管这个浏览器
+    keep_session 为 False 时同时清掉登录状态；为 True 时保留 Cookie，下次登录先尝试复用会话
     """
     try:
-        # ---------------------------------------------------------
-        # 1. 数据处理：将字典/列表转换为 "key=value; key=value" 字符串
-        # ---------------------------------------------------------
+        if not keep_session:
+            page.set.cookies.clear()
+        page.get('about:blank')
+    except Exception as e:
+        log(f"重置浏览器失败: {e}")
 
-        # 如果 page_cookies 是列表 (as_dict=False)，先转成字典便于处理
-        if isinstance(data.cookies, list):
-            cookie_dict = {item['name']: item['value'] for item in data.cookies}
-        else:
-            cookie_dict = data.cookies
-        cookie_string = "; ".join([f"{key}={value}" for key, value in cookie_dict.items()])
-
-        # ---------------------------------------------------------
-        # 2. 构造请求：
-        # ---------------------------------------------------------
-        headers = {
-            "xcookie": cookie_string,
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-
-        # 获取 CA 根证书的路径
-        ca_path = os.path.join("certs", "ca.crt")
-
-        log(f"正在发送 Cookie 到服务器: {server_url}")
-        # 发送 POST 请求
-        response = requests.post(
-            server_url,
-            headers=headers,
-            json=data.payload,
-            timeout=10,
-            verify=ca_path)
-        if response.status_code == 200:
-            res_json = response.json()
-            log("接口响应成功: " + str(res_json))
-        else:
-            log(f"接口报错，状态码: {response.status_code}, 内容: {response.text}")
 
-    except Exception as e:
-        log(f"发送请求时出错: {e}")
+class BrowserWorker:
+    """
+    DrissionPage 的调用都是阻塞的，统一放到这个单线程执行器里执行，事件循环只负责编排、等待和超时
+    只用一个线程，对同一个浏览器的操作按提交顺序依次执行
+    """
 
-def auto_login(config, mqtt_listener=None):
-    try:
-        page = init_browser_and_login(config)
-        if not page: return
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='browser')
+        self.page = None
+
+    async def call(self, fn, *args, step=None, **step_args):
+        """
+        在浏览器线程里执行 fn(*args)；给了 step 时按步骤记录耗时
+        """
+        def run():
+            if step is None:
+                return fn(*args)
+            with timed_step(step, **step_args):
+                return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    async def abort(self, mqtt_listener=None):
+        """
+        登录被取消或超时：直接关闭浏览器，浏览器线程里正在执行的操作随之报错返回；等验证码的也立即返回
+        """
+        if mqtt_listener is not None:
+            mqtt_listener.interrupt()
+        if self.page is not None:
+            try:
+                await asyncio.to_thread(self.page.quit)
+            except Exception as e:
+                log(f"关闭浏览器失败: {e}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
-        verify_res = handle_verification(page, config, mqtt_listener)
-        if not verify_res:
-            log("二次验证失败，流程终止")
-            return
 
-        process_cookies_and_keep_alive(page, config)
+async def login(browser, config, mqtt_listener):
+    """
+    打开浏览器并完成登录 (能复用上次会话时跳过登录和二次验证)，成功返回 page
+    """
+    from browser_session import SessionStore, create_page, try_resume_session
+    browser.page = await browser.call(create_page, config, step="启动浏览器")
+    if config.get('session_reuse', True):
+        if await browser.call(try_resume_session, browser.page, config, SessionStore(config), step="复用上次会话"):
+            return browser.page
+
+    page = await browser.call(init_browser_and_login, config, browser.page)
+    if not page:
+        return None
+
+    verify_res = await browser.call(handle_verification, page, config, mqtt_listener, step="二次验证")
+    if not verify_res:
+        log("二次验证失败，流程终止")
+        return None
+    return page
+
+
+async def auto_login(config, mqtt_listener=None, quit_browser=True):
+    """
+    执行一次完整的登录和保活，登录成功返回 True
+    quit_browser 为 False 时保活结束后不关闭浏览器 (常驻服务模式)
+    登录超过 login_timeout_minutes 仍未完成时关闭浏览器并放弃
+    配置了 trace_dir 时每次登录各阶段的耗时写成一个追踪文件
+    """
+    tracing.start_run(config)
+    browser = BrowserWorker()
+    try:
+        login_timeout = float(config.get('login_timeout_minutes', 10)) * 60
+        try:
+            page = await asyncio.wait_for(login(browser, config, mqtt_listener), login_timeout or None)
+        except asyncio.TimeoutError:
+            log(f"登录超过 {login_timeout / 60:.0f} 分钟仍未完成，放弃本次登录")
+            await browser.abort(mqtt_listener)
+            return False
+        if not page:
+            return False
+
+        await process_cookies_and_keep_alive(browser, page, config, quit_browser)
+        return True
+    except asyncio.CancelledError:
+        log("登录流程被取消，关闭浏览器")
+        await browser.abort(mqtt_listener)
+        raise
     except Exception as e:
         log(f"流程执行异常: {e}")
+        return False
+    finally:
+        browser.shutdown()
+        tracing.finish_run()
 
 
-if __name__ == '__main__':
-    current_config = load_config()
-    if current_config:
-        default_settings = {
-            'mqtt_username': 'sgsms',
-            'mqtt_password': '4$90*xyP$nqNocP',
-            'mqtt_topic': 'sms/verification',
-            'mqtt_host': '58.220.240.50',
-            'mqtt_port': 17181,
-            'mqtt_qos':2
-        }
-        current_config = {**default_settings, **current_config}
-    else:
-        log("配置读取失败")
-        exit()
+async def run(config, service_mode, started=None):
+    """
+    主程序的事件循环：本地代理、MQTT 监听和登录流程都在这里运行，退出时一起取消
+    """
+    loop = asyncio.get_running_loop()
+    background = []
+
+    # 整个程序的指标端点 (MQTT、Cookie 推送、浏览器资源，以及在本进程内运行的代理)，不依赖是否开启代理
+    metrics_server = None
+    metrics_port = int(config.get('metrics_port', 0))
+    if metrics_port:
+        from metrics import start_metrics_server
+        try:
+            metrics_server = await start_metrics_server(metrics_port)
+        except OSError as e:
+            log(f"指标端点启动失败: {e}")
 
     mqtt_service = None
-    if current_config.get('verification_mode') == 'sms':
+    if config.get('verification_mode') == 'sms':
         log("正在启动 MQTT 验证码监听服务...")
-        mqtt_service = MqttCodeListener(current_config)
-        mqtt_service.start()
+        from mqtt_handler import MqttCodeListener
+        mqtt_service = MqttCodeListener(config)
+        background.append(asyncio.create_task(mqtt_service.run_in_loop()))
 
-    if current_config.get('enable_local_proxy', False):
+    if config.get('enable_local_proxy', False):
         log("配置为开启：正在启动本地 Ukey 转发代理...")
-        proxy_thread = threading.Thread(target=wsproxy.run_proxy_server, daemon=True)
-        proxy_thread.start()
-        # 稍微等待一下让端口监听启动
-        time.sleep(1)
+        import wsproxy
+        proxy_task = asyncio.create_task(wsproxy.serve(config))
+        background.append(proxy_task)
+        # 等端口开始监听 (或代理已退出) 再继续，最多等 5 秒
+        with timed_step("启动本地代理"):
+            deadline = loop.time() + 5
+            while not (proxy_task.done() or port_listening(config.get('ukey_proxy_target_port'))) \
+                    and loop.time() < deadline:
+                await asyncio.sleep(0.05)
     else:
         log("配置为关闭：跳过启动本地 Ukey 转发代理")
 
+    watch_interval = float(config.get('config_watch_interval_seconds', 0))
+    if watch_interval > 0 and getattr(config, 'path', None):
+        import settings
+        # 热加载日志级别；保活间隔和代理设置在各自用到的地方读取
+        config.on_reload(lambda changed: 'log_level' in changed and configure_log(config))
+        background.append(asyncio.create_task(settings.watch(config, watch_interval)))
+
+    if started is not None and config.get('profile_startup', False):
+        log(f"[启动分析] 从读取配置到开始登录耗时 {time.perf_counter() - started:.3f} s")
+
     try:
-        auto_login(current_config, mqtt_listener=mqtt_service)
-    except Exception as e:
-        log(f"程序运行出错: {e}")
+        if service_mode:
+            from service import LoginService
+            log("以常驻服务模式运行")
+
+            running = {}
+
+            def run_login(config, mqtt_listener, quit_browser):
+                # 服务线程里调用，登录流程仍在事件循环里执行
+                future = asyncio.run_coroutine_threadsafe(auto_login(config, mqtt_listener, quit_browser), loop)
+                running['future'] = future
+                try:
+                    return future.result()
+                except concurrent.futures.CancelledError:
+                    return False
+                finally:
+                    running.pop('future', None)
+
+            def abort_login():
+                # 取消登录任务，auto_login 里按取消处理：关闭浏览器、打断等验证码
+                future = running.get('future')
+                if future is not None:
+                    future.cancel()
+
+            service = LoginService(config, run_login, mqtt_service, abort_login)
+            try:
+                await loop.run_in_executor(None, service.serve_forever)
+            finally:
+                service.stop()
+        else:
+            await auto_login(config, mqtt_listener=mqtt_service)
     finally:
         # 释放资源
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if metrics_server is not None:
+            metrics_server.close()
         if mqtt_service:
-            mqtt_service.stop()
-            log("MQTT 服务已关闭")
\ No newline at end of file
+            log("MQTT 服务已关闭")
+
+
+if __name__ == '__main__':
+    # 打包成 exe 后，代理工作进程 (proxy_workers) 需要这句才能正确启动
+    multiprocessing.freeze_support()
+    started = time.perf_counter()
+    # 读取并校验一次配置，此后各模块共用这个对象；MQTT 等默认值在 settings.SCHEMA 里
+    current_config = load_config()
+    if current_config:
+        configure_log(current_config)
+        if current_config.get('profile_startup', False):
+            # 统计此后每个模块的导入耗时，结束时写进日志
+            import_timer.enable()
+    else:
+        log("配置读取失败，请按上面的提示修改 config.json")
+        sys.exit(1)
+
+    # 常驻服务模式：代理和 MQTT 监听一直运行，按 service_schedule 定时登录，不再每次由计划任务重新拉起
+    service_mode = '--service' in sys.argv or current_config.get('service_mode', False)
+
+    if sys.platform == 'win32':
+        # MQTT 的 socket 挂在事件循环上 (add_reader)，Windows 下要用 SelectorEventLoop
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    try:
+        asyncio.run(run(current_config, service_mode, started))
+    except KeyboardInterrupt:
+        log("收到中断，退出")
+    except Exception as e:
+        log(f"程序运行出错: {e}")
+    finally:
+        if current_config.get('profile_startup', False):
+            import_timer.report()
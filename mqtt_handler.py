@@ -1,10 +1,50 @@
+import asyncio
+import hashlib
 import json
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import re
+import socket
+import threading
 import time
+from collections import namedtuple
 from utils import log
+from metrics import Counter, Gauge, Histogram
+
+MQTT_CONNECTED = Gauge('sms_mqtt_connected', 'MQTT 当前是否已连接')
+MQTT_CONNECT_SECONDS = Histogram('sms_mqtt_connect_seconds', '发起 MQTT 连接到收到 CONNACK 的耗时')
+MQTT_CONNECT_FAILURES = Counter('sms_mqtt_connect_failures_total', 'MQTT 连接失败次数')
+MQTT_DISCONNECTS = Counter('sms_mqtt_disconnects_total', 'MQTT 意外断线次数')
+# 消息里带发布时间 (timestamp/ts，秒或毫秒) 时才统计
+MQTT_DELIVERY_DELAY_SECONDS = Histogram('sms_mqtt_delivery_delay_seconds', '验证码消息从发布到本机收到的耗时')
+SMS_CODE_WAIT_SECONDS = Histogram(
+    'sms_code_wait_seconds', '点击发送验证码到收到验证码的耗时',
+    buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300))
+
+# 一条收到的验证码：code 验证码，username 消息里的用户，received_at 收到时间 (time.time())，
+# sent_at 消息里带的发布时间 (秒，没带时为 None)
+SmsCode = namedtuple('SmsCode', ['code', 'username', 'received_at', 'sent_at'])
+
+# 用发布时间判断验证码是否过期时，容忍发送端和本机的时钟偏差
+SENT_TS_SKEW_SECONDS = 5
+
+
+def default_client_id(username):
+    """
+    默认的 MQTT 客户端 ID：按账号和本机区分，各处运行时不会共用同一个持久会话，互相踢下线、收走对方的验证码
+    """
+    parts = []
+    if username:
+        # 中文等字符不一定被服务器接受，换成账号的短哈希
+        parts.append(username if re.fullmatch(r'[0-9A-Za-z_.-]+', username)
+                     else hashlib.sha1(username.encode('utf-8')).hexdigest()[:8])
+    host = re.sub(r'[^0-9A-Za-z_.-]+', '_', socket.gethostname()).strip('_')
+    if host:
+        parts.append(host)
+    return '-'.join(['sg_auto_login'] + parts)
 
 
 class MqttCodeListener:
@@ -12,25 +52,79 @@ class MqttCodeListener:
         self.config = config
         self.topic = config.get('mqtt_topic')
         self.qos = config.get('mqtt_qos')
-        client_id = 'sg_auto_login'
-        self.client = mqtt.Client(
-            callback_api_version = CallbackAPIVersion.VERSION2,
-            client_id = client_id
-        )
+        # 持久会话靠 client_id 识别，不配置时按账号和机器名生成
+        client_id = config.get('mqtt_client_id') or default_client_id(config.get('username'))
+        self.protocol_v5 = str(config.get('mqtt_protocol', '3.1.1')) == '5'
+        if self.protocol_v5:
+            self.client = mqtt.Client(
+                callback_api_version = CallbackAPIVersion.VERSION2,
+                client_id = client_id,
+                protocol = mqtt.MQTTv5
+            )
+        else:
+            # 3.1.1 下 clean_session=False 即持久会话，断线期间的 QoS 1/2 消息由服务器保留，重连后补发
+            self.client = mqtt.Client(
+                callback_api_version = CallbackAPIVersion.VERSION2,
+                client_id = client_id,
+                clean_session = False
+            )
         self.client.username_pw_set(config.get('mqtt_username'), config.get('mqtt_password'))
-        self.received_code = None
+        self._connect_started = None
+        # 验证码在事件循环线程里写入、浏览器线程取走，读写都在 _cond 的锁内
+        self._cond = threading.Condition()
+        self._code = None
+        # 最近一次点击“发送验证码”的时间，早于它收到的验证码一律作废
+        self._requested_at = None
+        # 登录流程被取消时置位，让阻塞在 get_code 里的线程立即返回
+        self._interrupted = False
+        # run_in_loop 驱动时，断线由 _on_disconnect 通知重连循环
+        self._loop = None
+        self._lost = None
+        self._session_up = False
+        self.client.on_pre_connect = self._on_pre_connect
         self.client.on_connect = self._on_connect
+        self.client.on_connect_fail = self._on_connect_fail
+        self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
 
+    def _on_pre_connect(self, client, userdata):
+        self._connect_started = time.monotonic()
+
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         """
         连接成功后的回调
         """
+        connect_text = ''
+        if self._connect_started is not None:
+            elapsed = time.monotonic() - self._connect_started
+            MQTT_CONNECT_SECONDS.observe(elapsed)
+            connect_text = f"，耗时 {elapsed:.3f} 秒"
+            self._connect_started = None
         if reason_code == 0:
-            log(f"MQTT 连接成功，正在订阅主题: {self.topic}")
+            self._session_up = True
+            MQTT_CONNECTED.set(1)
+            # 服务器保留了会话时订阅仍然有效，重新订阅也无妨
+            log(f"MQTT 连接成功 (会话保留: {flags.session_present}{connect_text})，正在订阅主题: {self.topic}")
             client.subscribe(self.topic, qos=self.qos)
         else:
+            MQTT_CONNECT_FAILURES.inc()
             log(f"MQTT 连接失败，原因码: {reason_code}")
+            self._notify_lost()
+
+    def _on_connect_fail(self, client, userdata):
+        MQTT_CONNECT_FAILURES.inc()
+        log("MQTT 连接失败，稍后自动重试")
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        MQTT_CONNECTED.set(0)
+        if reason_code != 0:
+            MQTT_DISCONNECTS.inc()
+            log(f"MQTT 连接断开 (原因码: {reason_code})，稍后自动重连")
+        self._notify_lost()
+
+    def _notify_lost(self):
+        if self._lost is not None:
+            self._loop.call_soon_threadsafe(self._lost.set)
 
     def _on_message(self, client, userdata, msg):
         try:
@@ -43,6 +137,7 @@ class MqttCodeListener:
 
             msg_user = None
             code = None
+            sent_ts = None
 
             #尝试标准解析 (处理可能存在的双重 JSON)
             try:
@@ -52,6 +147,7 @@ class MqttCodeListener:
                 if isinstance(data, dict):
                     msg_user = data.get('username')
                     code = data.get('code')
+                    sent_ts = data.get('timestamp', data.get('ts'))
             except Exception:
                 pass
 
@@ -84,47 +180,174 @@ class MqttCodeListener:
                 log(f"用户不匹配，忽略。")
                 return
 
-            self.received_code = code
-            log(f"成功捕获验证码: {self.received_code}")
+            sms_code = SmsCode(code, msg_user, time.time(), self._parse_sent_ts(sent_ts))
+            if sms_code.sent_at is not None:
+                MQTT_DELIVERY_DELAY_SECONDS.observe(max(0.0, sms_code.received_at - sms_code.sent_at))
+            with self._cond:
+                requested_at = self._requested_at
+                # 持久会话重连时服务器会补发排队的旧消息，收到时间可能晚于点击；消息里带发布时间时以它为准
+                if sms_code.sent_at is not None:
+                    stale = requested_at is not None and sms_code.sent_at < requested_at - SENT_TS_SKEW_SECONDS
+                else:
+                    stale = requested_at is not None and sms_code.received_at < requested_at
+                if stale:
+                    log(f"验证码 {code} 早于最近一次发送请求，忽略。")
+                    return
+                self._code = sms_code
+                self._cond.notify_all()
+            if requested_at is not None:
+                SMS_CODE_WAIT_SECONDS.observe(sms_code.received_at - requested_at)
+            delay_text = ''
+            if sms_code.sent_at is not None:
+                delay_text = f" (发布后 {max(0.0, sms_code.received_at - sms_code.sent_at):.3f} 秒送达)"
+            log(f"成功捕获验证码: {code}{delay_text}")
 
         except Exception as e:
             log(f"处理 MQTT 消息时发生未知错误: {e}")
 
-    def start(self):
+    @staticmethod
+    def _parse_sent_ts(sent_ts):
+        """
+        消息里的发布时间 (秒或毫秒) 转成秒，没有或无法解析时返回 None
+        """
         try:
-            log(f"正在连接 MQTT 服务器: {self.config['mqtt_host']}...")
-            raw_port = self.config.get('mqtt_port')
-            mqtt_port = int(raw_port)
-            self.client.connect(
-                self.config['mqtt_host'],
-                mqtt_port,
-                60
-            )
-            # loop_start 会启动一个后台线程，不断调用上面那些回调函数
-            self.client.loop_start()
-        except Exception as e:
-            log(f"MQTT 启动失败: {e}")
+            sent_ts = float(sent_ts)
+        except (TypeError, ValueError):
+            return None
+        if sent_ts > 1e12:
+            # 毫秒时间戳
+            sent_ts /= 1000
+        return sent_ts if sent_ts > 0 else None
+
+    def _connect(self):
+        mqtt_port = int(self.config.get('mqtt_port'))
+        if self.protocol_v5:
+            # MQTT 5：不清空会话，断线后会话在服务器上保留 mqtt_session_expiry_seconds 秒
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = int(self.config.get('mqtt_session_expiry_seconds', 3600))
+            self.client.connect(self.config['mqtt_host'], mqtt_port, 60, clean_start=False, properties=properties)
+        else:
+            self.client.connect(self.config['mqtt_host'], mqtt_port, 60)
+
+    async def run_in_loop(self):
+        """
+        在当前的 asyncio 事件循环里驱动 MQTT (不使用 paho 的网络线程)：
+        socket 的读写挂在事件循环上，断线后按退避时间重连，等待时间从 1 秒起翻倍，最多 mqtt_reconnect_max_delay_seconds 秒；
+        任务被取消时断开连接
+        """
+        loop = asyncio.get_running_loop()
+        client = self.client
+        self._loop = loop
+        self._lost = asyncio.Event()
+        max_delay = float(self.config.get('mqtt_reconnect_max_delay_seconds', 30))
+        delay = 1
+
+        def register_write(c, userdata, sock):
+            loop.add_writer(sock, c.loop_write)
+
+        def unregister_write(c, userdata, sock):
+            loop.remove_writer(sock)
+
+        def socket_close(c, userdata, sock):
+            loop.remove_reader(sock)
+
+        log(f"正在连接 MQTT 服务器: {self.config['mqtt_host']}...")
+        try:
+            while True:
+                # 建连 (DNS、TCP) 是阻塞的，放到线程里做，期间不挂 socket 回调
+                client.on_socket_register_write = None
+                client.on_socket_unregister_write = None
+                client.on_socket_close = None
+                self._lost.clear()
+                self._session_up = False
+                try:
+                    await loop.run_in_executor(None, self._connect)
+                except Exception as e:
+                    MQTT_CONNECT_FAILURES.inc()
+                    log(f"MQTT 连接失败: {e}，{delay:.0f} 秒后重试")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+                    continue
+
+                sock = client.socket()
+                loop.add_reader(sock, client.loop_read)
+                client.on_socket_register_write = register_write
+                client.on_socket_unregister_write = unregister_write
+                client.on_socket_close = socket_close
+                if client.want_write():
+                    loop.add_writer(sock, client.loop_write)
+
+                # 心跳和超时检查
+                while not self._lost.is_set():
+                    try:
+                        await asyncio.wait_for(self._lost.wait(), 1)
+                    except asyncio.TimeoutError:
+                        client.loop_misc()
+                # 连上过就从 1 秒重新开始退避
+                delay = 1 if self._session_up else min(delay * 2, max_delay)
+                await asyncio.sleep(delay)
+        finally:
+            sock = client.socket()
+            if sock is not None:
+                try:
+                    loop.remove_reader(sock)
+                    loop.remove_writer(sock)
+                except (ValueError, OSError):
+                    pass
+            client.on_socket_register_write = None
+            client.on_socket_unregister_write = None
+            client.on_socket_close = None
+            client.disconnect()
+            MQTT_CONNECTED.set(0)
+            self._lost = None
+            log("MQTT 监听已停止")
+
+    def interrupt(self):
+        """
+        让正在 get_code 里等待的线程立即返回 None (登录流程被取消或超时时调用)
+        """
+        with self._cond:
+            self._interrupted = True
+            self._cond.notify_all()
+
+    @property
+    def received_code(self):
+        with self._cond:
+            return self._code.code if self._code else None
 
     def clear_code(self):
         """
         显式清空已收到的验证码缓存。
-        在重新点击“发送验证码”按钮前调用，防止拿到旧的验证码。
         """
-        if self.received_code:
-            log(f"清理旧验证码缓存: {self.received_code}")
-        self.received_code = None
+        with self._cond:
+            if self._code:
+                log(f"清理旧验证码缓存: {self._code.code}")
+            self._code = None
+
+    def mark_code_requested(self):
+        """
+        在点击“发送验证码”按钮前调用：清空缓存，并记下时间，此后只接受这之后收到的验证码，防止拿到旧的验证码。
+        """
+        with self._cond:
+            if self._code:
+                log(f"清理旧验证码缓存: {self._code.code}")
+            self._code = None
+            self._requested_at = time.time()
+            self._interrupted = False
 
     def get_code(self, timeout=60):
+        """
+        阻塞等待验证码，_on_message 收下验证码后立即返回；超时返回 None
+        没调用过 mark_code_requested 时，只接受调用本方法之后收到的验证码
+        """
         log(f"开始在主题 {self.topic} 中等待验证码...")
-        self.received_code = None
-        start_t = time.time()
-        while time.time() - start_t < timeout:
-            if self.received_code:
-                return self.received_code
-            time.sleep(1)
-        return None
-
-    def stop(self):
-        log("停止 MQTT 监听器...")
-        self.client.loop_stop()
-        self.client.disconnect()
+        with self._cond:
+            if self._requested_at is None:
+                self._requested_at = time.time()
+                self._code = None
+            if not self._cond.wait_for(lambda: self._code is not None or self._interrupted, timeout) \
+                    or self._code is None:
+                return None
+            sms_code, self._code = self._code, None
+        log(f"验证码 {sms_code.code} 收到后 {time.time() - sms_code.received_at:.3f} 秒交给登录流程")
+        return sms_code.code
@@ -0,0 +1,267 @@
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import log, get_base_path
+
+STATE_IDLE = 'idle'
+STATE_RUNNING = 'running'
+
+# 控制接口的令牌放在这个请求头里
+TOKEN_HEADER = 'X-Control-Token'
+# 没有配置 service_control_token 时自动生成，保存在程序目录的这个文件里
+TOKEN_FILE = 'service_token.txt'
+
+
+def parse_schedule(schedule):
+    """
+    解析每天的登录时间列表，如 ["07:30", "13:00"]，返回排好序的 (时, 分)
+    """
+    times = []
+    for item in schedule or []:
+        try:
+            hour, minute = (int(part) for part in str(item).split(':'))
+        except ValueError:
+            log(f"[服务] 忽略无法识别的登录时间: {item}")
+            continue
+        if 0 <= hour < 24 and 0 <= minute < 60:
+            times.append((hour, minute))
+        else:
+            log(f"[服务] 忽略无法识别的登录时间: {item}")
+    return sorted(set(times))
+
+
+def load_control_token(config):
+    """
+    控制接口的令牌：优先用 service_control_token，没配置时读取 (或生成) 程序目录下的 service_token.txt
+    """
+    token = config.get('service_control_token')
+    if token:
+        return str(token)
+    path = os.path.join(get_base_path(), TOKEN_FILE)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        token = None
+    if not token:
+        token = secrets.token_urlsafe(24)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(token)
+        log(f"[服务] 已生成控制接口令牌，保存在 {path}")
+    return token
+
+
+def next_run_time(times, now):
+    for hour, minute in times:
+        candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if candidate > now:
+            return candidate
+    if not times:
+        return None
+    hour, minute = times[0]
+    return (now + timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+
+class LoginService:
+    """
+    常驻服务：代理、MQTT 监听 (以及可选的浏览器) 在多次登录之间保持运行，
+    按 service_schedule 定时登录，也可以通过本机控制接口手动触发、查看状态
+    run_login 为执行一次登录的函数，签名为 run_login(config, mqtt_listener, quit_browser)，返回是否成功；
+    abort_login 为中止正在进行的登录 (含保活) 的函数，stop() 时调用
+    """
+
+    def __init__(self, config, run_login, mqtt_listener=None, abort_login=None):
+        self.config = config
+        self.run_login = run_login
+        self.abort_login = abort_login
+        self.mqtt_listener = mqtt_listener
+        self.schedule = parse_schedule(config.get('service_schedule', []))
+        # 为 True 时两次登录之间不关闭浏览器，下次直接接管已打开的 Chromium
+        self.keep_browser = config.get('service_keep_browser', False)
+        self.state = STATE_IDLE
+        self.started_at = datetime.now()
+        self.next_run = None
+        self.runs = 0
+        self.last_run = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._trigger = False
+        self._stopping = False
+        self._control_server = None
+
+    # ------------------------------------------------------------------
+    # 控制
+    # ------------------------------------------------------------------
+
+    def trigger(self):
+        """
+        请求立即登录一次，正在登录时返回 False
+        """
+        with self._lock:
+            if self.state == STATE_RUNNING or self._trigger:
+                return False
+            self._trigger = True
+        self._wake.set()
+        return True
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        # 正在登录或保活时一并中止，和登录超时的处理一样关闭浏览器
+        if self.state == STATE_RUNNING and self.abort_login is not None:
+            log("[服务] 中止正在进行的登录")
+            self.abort_login()
+
+    def status(self):
+        with self._lock:
+            status = {
+                'state': self.state,
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'next_run': self.next_run.isoformat(timespec='seconds') if self.next_run else None,
+                'schedule': [f"{h:02d}:{m:02d}" for h, m in self.schedule],
+                'runs': self.runs,
+                'last_run': dict(self.last_run) if self.last_run else None,
+                'keep_browser': self.keep_browser,
+            }
+        if self.mqtt_listener is not None:
+            status['mqtt_connected'] = self.mqtt_listener.client.is_connected()
+        return status
+
+    # ------------------------------------------------------------------
+    # 主循环
+    # ------------------------------------------------------------------
+
+    def serve_forever(self):
+        port = int(self.config.get('service_control_port', 17890))
+        if port:
+            self._start_control_server(port)
+        if not self.schedule:
+            log("[服务] 未配置 service_schedule，只能通过控制接口触发登录")
+        if self.config.get('service_run_on_start', False):
+            self._trigger = True
+
+        try:
+            while not self._stopping:
+                self.next_run = next_run_time(self.schedule, datetime.now())
+                if not self._trigger:
+                    if self.next_run:
+                        log(f"[服务] 下次登录时间: {self.next_run.strftime('%Y-%m-%d %H:%M')}")
+                    self._wait_until(self.next_run)
+                    if self._stopping:
+                        break
+                    if not self._trigger and (self.next_run is None or datetime.now() < self.next_run):
+                        continue
+                self._run_once()
+        except KeyboardInterrupt:
+            log("[服务] 收到中断，退出")
+        finally:
+            if self._control_server is not None:
+                self._control_server.shutdown()
+
+    def _wait_until(self, when):
+        # 被 trigger/stop 唤醒，或到点返回；分段等待，Windows 下 Ctrl+C 才能及时响应
+        while True:
+            remaining = (when - datetime.now()).total_seconds() if when else 1
+            if remaining <= 0:
+                return
+            if self._wake.wait(min(remaining, 1)):
+                self._wake.clear()
+                return
+
+    def _run_once(self):
+        with self._lock:
+            self._trigger = False
+            self.state = STATE_RUNNING
+            self.runs += 1
+            self.last_run = {'started_at': datetime.now().isoformat(timespec='seconds')}
+        log(f"[服务] 开始第 {self.runs} 次登录")
+        start = time.monotonic()
+        ok = False
+        error = None
+        try:
+            ok = bool(self.run_login(self.config, self.mqtt_listener, not self.keep_browser))
+        except Exception as e:
+            error = str(e)
+            log(f"[服务] 登录异常: {e}")
+        finally:
+            with self._lock:
+                self.state = STATE_IDLE
+                self.last_run.update(
+                    finished_at=datetime.now().isoformat(timespec='seconds'),
+                    seconds=round(time.monotonic() - start, 1),
+                    success=ok,
+                    error=error,
+                )
+        log(f"[服务] 第 {self.runs} 次登录结束，{'成功' if ok else '失败'}，耗时 {time.monotonic() - start:.1f} 秒")
+
+    # ------------------------------------------------------------------
+    # 本机控制接口：GET /status，POST /run，POST /stop
+    # 请求头里要带令牌；带 Origin 的请求 (浏览器里的网页发起的) 一律拒绝
+    # ------------------------------------------------------------------
+
+    def _start_control_server(self, port):
+        service = self
+        try:
+            token = load_control_token(self.config)
+        except OSError as e:
+            log(f"[服务] 控制接口令牌读写失败，控制接口不启动: {e}")
+            return
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, body):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _authorized(self):
+                if self.headers.get('Origin') is not None:
+                    self._reply(403, {'error': 'cross-origin requests are not allowed'})
+                    return False
+                if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode('utf-8'), token.encode('utf-8')):
+                    self._reply(401, {'error': f'missing or invalid {TOKEN_HEADER} header'})
+                    return False
+                return True
+
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                if self.path.split('?')[0] in ('/', '/status'):
+                    self._reply(200, service.status())
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                path = self.path.split('?')[0]
+                if path == '/run':
+                    if service.trigger():
+                        self._reply(202, {'result': 'triggered'})
+                    else:
+                        self._reply(409, {'result': 'busy', 'state': service.state})
+                elif path == '/stop':
+                    self._reply(202, {'result': 'stopping'})
+                    service.stop()
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._control_server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        except OSError as e:
+            log(f"[服务] 控制接口启动失败: {e}")
+            return
+        self._control_server.daemon_threads = True
+        threading.Thread(target=self._control_server.serve_forever, name='service-control', daemon=True).start()
+        log(f"[服务] 控制接口: http://127.0.0.1:{port}/status (POST /run 立即登录，POST /stop 中止并退出，"
+            f"请求头需带 {TOKEN_HEADER})")
@@ -0,0 +1,329 @@
+import asyncio
+import json
+import math
+import os
+import re
+import threading
+from collections import namedtuple
+from utils import log, get_base_path
+
+CONFIG_FILE = 'config.json'
+
+# kind: str / int / float / bool / list；default 为 None 时不填默认值，由使用处决定；
+# choices 为允许的取值；minimum 为数值下限
+Field = namedtuple('Field', ['kind', 'default', 'choices', 'minimum'], defaults=(None, None, None))
+
+SCHEMA = {
+    # 登录
+    'url': Field('str'),
+    'username': Field('str'),
+    'password': Field('str'),
+    'ukey_pin': Field('str'),
+    'verification_mode': Field('str', 'ukey', choices=('ukey', 'sms')),
+    'login_timeout_minutes': Field('float', 10, minimum=0),
+    'session_reuse': Field('bool', True),
+    'session_max_age_hours': Field('float', 12, minimum=0),
+    'session_check_timeout_seconds': Field('float', 5, minimum=0),
+    'session_dashboard_selector': Field('str'),
+    'wait_element_timeout_seconds': Field('float', 10, minimum=0),
+    'wait_captcha_timeout_seconds': Field('float', 10, minimum=0),
+    'wait_slider_result_timeout_seconds': Field('float', 6, minimum=0),
+    'wait_sms_resend_timeout_seconds': Field('float', 70, minimum=0),
+    'wait_sms_code_timeout_seconds': Field('float', 80, minimum=0),
+    'wait_dashboard_timeout_seconds': Field('float', 10, minimum=0),
+    # 浏览器
+    'browser_profile_dir': Field('str', 'browser_profile'),
+    'browser_cache_dir': Field('str'),
+    'browser_cache_size_mb': Field('int', 0, minimum=0),
+    'browser_block_urls': Field('list', []),
+    'browser_watchdog_interval_seconds': Field('float', 60, minimum=0),
+    'browser_memory_budget_mb': Field('float', 0, minimum=0),
+    'browser_cpu_budget_percent': Field('float', 0, minimum=0),
+    'browser_recycle_min_interval_minutes': Field('float', 10, minimum=0),
+    'browser_recycle_max_consecutive': Field('int', 3, minimum=0),
+    # 保活和 Cookie 推送
+    'keep_alive_duration_hours': Field('float', 2, minimum=0),
+    'keep_alive_interval_minutes': Field('float', 10, minimum=0),
+    'push_server_url': Field('str'),
+    'cookie_push_max_backoff_seconds': Field('float', 300, minimum=1),
+    'cookie_spool_max_age_minutes': Field('float', 60, minimum=0),
+    # MQTT
+    'mqtt_host': Field('str', '58.220.240.50'),
+    'mqtt_port': Field('int', 17181, minimum=1),
+    'mqtt_username': Field('str', 'sgsms'),
+    'mqtt_password': Field('str', '4$90*xyP$nqNocP'),
+    'mqtt_topic': Field('str', 'sms/verification'),
+    'mqtt_qos': Field('int', 2, choices=(0, 1, 2)),
+    'mqtt_client_id': Field('str'),
+    'mqtt_protocol': Field('str', '3.1.1', choices=('3.1.1', '5')),
+    'mqtt_session_expiry_seconds': Field('int', 3600, minimum=0),
+    'mqtt_reconnect_max_delay_seconds': Field('float', 30, minimum=1),
+    # 本地代理
+    'enable_local_proxy': Field('bool', False),
+    'ukey_proxy_target_ip': Field('str'),
+    'ukey_proxy_target_port': Field('int', minimum=1),
+    'ukey_proxy_targets': Field('list'),
+    'proxy_relay_mode': Field('str', 'stream', choices=('stream', 'buffered')),
+    'proxy_log_payload': Field('bool', True),
+    'proxy_pool_size': Field('int', 0, minimum=0),
+    'proxy_pool_idle_ttl_seconds': Field('float', 60, minimum=1),
+    'proxy_write_buffer_high_kb': Field('int', 256, minimum=1),
+    'proxy_write_buffer_low_kb': Field('int', 64, minimum=0),
+    'proxy_idle_timeout_seconds': Field('float', 0, minimum=0),
+    'proxy_half_close_timeout_seconds': Field('float', 5, minimum=0),
+    'proxy_workers': Field('int', 0, minimum=0),
+    'proxy_tls_curve': Field('str'),
+    'proxy_metrics_port': Field('int', 0, minimum=0),
+    'metrics_port': Field('int', 0, minimum=0),
+    'proxy_capture_file': Field('str'),
+    'proxy_capture_redact_keys': Field('list'),
+    'proxy_probe_interval_seconds': Field('float', 10, minimum=0),
+    'proxy_probe_timeout_seconds': Field('float', 2, minimum=0),
+    'proxy_upstream_connect_timeout_seconds': Field('float', 5, minimum=0),
+    # 常驻服务
+    'service_mode': Field('bool', False),
+    'service_schedule': Field('list', []),
+    'service_run_on_start': Field('bool', False),
+    'service_keep_browser': Field('bool', False),
+    'service_control_port': Field('int', 17890, minimum=0),
+    'service_control_token': Field('str'),
+    # 日志、诊断
+    'log_level': Field('str', 'DEBUG', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR')),
+    'log_max_mb': Field('float', 10, minimum=0),
+    'log_backup_count': Field('int', 5, minimum=0),
+    'log_rotate_days': Field('float', 0, minimum=0),
+    'profile_startup': Field('bool', False),
+    'trace_dir': Field('str'),
+    'trace_cprofile': Field('bool', False),
+    'trace_tracemalloc': Field('bool', False),
+    'config_watch_interval_seconds': Field('float', 0, minimum=0),
+}
+
+# 运行中修改 config.json 后可以直接生效的配置项，其余的要重启
+RELOADABLE = frozenset({
+    'keep_alive_interval_minutes', 'keep_alive_duration_hours',
+    'proxy_log_payload', 'proxy_write_buffer_high_kb', 'proxy_write_buffer_low_kb',
+    'proxy_idle_timeout_seconds', 'proxy_half_close_timeout_seconds', 'proxy_pool_idle_ttl_seconds',
+    'proxy_probe_interval_seconds', 'proxy_probe_timeout_seconds', 'proxy_upstream_connect_timeout_seconds',
+    'log_level',
+})
+
+_SCHEDULE_RE = re.compile(r'^([01]?\d|2[0-3]):[0-5]\d$')
+
+_cached = None
+_cache_lock = threading.Lock()
+
+
+class ConfigError(Exception):
+    """
+    配置文件缺失或有不合法的配置项，problems 为逐条的问题说明
+    """
+
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super().__init__("; ".join(self.problems))
+
+
+class Config(dict):
+    """
+    校验过的配置：按 SCHEMA 转换好类型、填好默认值，仍可以像字典一样 config.get(key, default)，
+    也可以直接用属性读取，如 config.keep_alive_interval_minutes (没配置且没有默认值的项为 None)
+    热加载时原地更新，各模块拿到的是同一个对象
+    """
+
+    def __init__(self, values, path=None):
+        super().__init__(values)
+        self.path = path
+        self._listeners = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self:
+            return self[name]
+        if name in SCHEMA:
+            return None
+        raise AttributeError(name)
+
+    def __reduce__(self):
+        # 传给代理工作进程时只带配置值，不带热加载回调
+        return Config, (dict(self), self.path)
+
+    def on_reload(self, callback):
+        """
+        注册热加载回调 callback(changed_keys)，在热加载所在的事件循环线程里调用
+        """
+        self._listeners.append(callback)
+
+    def apply_reload(self, new_config):
+        """
+        把新配置里可热加载的改动写进当前对象并通知回调，返回 (已生效的项, 需要重启的项)
+        """
+        changed = {key for key in set(self) | set(new_config) if self.get(key) != new_config.get(key)}
+        applied = changed & RELOADABLE
+        for key in applied:
+            if key in new_config:
+                self[key] = new_config[key]
+            else:
+                self.pop(key, None)
+        for callback in list(self._listeners):
+            try:
+                callback(applied)
+            except Exception as e:
+                log(f"[配置] 热加载回调出错: {e}")
+        return applied, changed - applied
+
+
+def _coerce(key, field, value, problems):
+    kind = field.kind
+    if kind == 'bool':
+        if isinstance(value, bool):
+            return value
+    elif kind == 'int':
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().isdigit():
+            return int(value)
+    elif kind == 'float':
+        if not isinstance(value, bool):
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                number = None
+            # "nan"、"inf" (以及 JSON 里的 NaN/Infinity) 能转成 float，但会让时间计算出错
+            if number is not None and math.isfinite(number):
+                return number
+    elif kind == 'str':
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # 如 mqtt_protocol 写成了数字 5
+            return str(value)
+    elif kind == 'list':
+        if isinstance(value, list):
+            return value
+    problems.append(f"{key} 应为 {kind}，实际为 {value!r}")
+    return None
+
+
+def validate(raw, path=None):
+    """
+    校验并转换原始配置字典，返回 Config；有问题时一次性列出全部问题抛出 ConfigError
+    """
+    if not isinstance(raw, dict):
+        raise ConfigError(["配置文件的顶层应为 JSON 对象"])
+    problems = []
+    values = {}
+    for key, value in raw.items():
+        field = SCHEMA.get(key)
+        if field is None:
+            # 未知项不算错误，只提醒一下，多半是拼错了
+            log(f"[配置] 未知的配置项: {key}")
+            values[key] = value
+            continue
+        if value is None:
+            continue
+        value = _coerce(key, field, value, problems)
+        if value is None:
+            continue
+        if key == 'log_level':
+            value = value.upper()
+        if field.choices is not None and value not in field.choices:
+            problems.append(f"{key} 只能是 {' / '.join(str(c) for c in field.choices)}，实际为 {value!r}")
+            continue
+        if field.minimum is not None and value < field.minimum:
+            problems.append(f"{key} 不能小于 {field.minimum}，实际为 {value!r}")
+            continue
+        values[key] = value
+
+    for key, field in SCHEMA.items():
+        if key not in values and field.default is not None:
+            values[key] = list(field.default) if isinstance(field.default, list) else field.default
+
+    # 各项之间的关系
+    for key in ('url', 'username', 'password'):
+        if not values.get(key):
+            problems.append(f"缺少 {key}")
+    if values['verification_mode'] == 'ukey' and not values.get('ukey_pin'):
+        problems.append("verification_mode 为 ukey 时需要配置 ukey_pin")
+    if values['enable_local_proxy']:
+        if not values.get('ukey_proxy_target_port'):
+            problems.append("开启本地代理时需要配置 ukey_proxy_target_port")
+        if not values.get('ukey_proxy_target_ip') and not values.get('ukey_proxy_targets'):
+            problems.append("开启本地代理时需要配置 ukey_proxy_target_ip 或 ukey_proxy_targets")
+        if values.get('ukey_proxy_targets'):
+            from wsproxy import parse_targets
+            try:
+                parse_targets(values['ukey_proxy_targets'], values.get('ukey_proxy_target_port') or 1)
+            except ValueError as e:
+                problems.append(f"ukey_proxy_targets 有误: {e}")
+    if values['proxy_write_buffer_low_kb'] > values['proxy_write_buffer_high_kb']:
+        problems.append("proxy_write_buffer_low_kb 不能大于 proxy_write_buffer_high_kb")
+    for item in values['service_schedule']:
+        if not _SCHEDULE_RE.match(str(item)):
+            problems.append(f"service_schedule 中的时间应为 HH:MM，实际为 {item!r}")
+    for key in ('service_control_port', 'proxy_metrics_port', 'metrics_port', 'mqtt_port', 'ukey_proxy_target_port'):
+        if values.get(key) is not None and values[key] > 65535:
+            problems.append(f"{key} 不是有效端口: {values[key]}")
+
+    if problems:
+        raise ConfigError(problems)
+    return Config(values, path)
+
+
+def load(path=None):
+    """
+    读取并校验配置文件，不走缓存
+    """
+    path = path or os.path.join(get_base_path(), CONFIG_FILE)
+    if not os.path.exists(path):
+        raise ConfigError([f"找不到配置文件 {path}"])
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError([f"读取配置文件 {path} 失败: {e}"])
+    return validate(raw, path)
+
+
+def get_config():
+    """
+    进程内只读取、校验一次配置文件，之后都返回同一个 Config
+    """
+    global _cached
+    with _cache_lock:
+        if _cached is None:
+            _cached = load()
+        return _cached
+
+
+async def watch(config, interval):
+    """
+    每 interval 秒检查一次配置文件，有修改就重新校验，把可热加载的项写进 config；
+    新内容不合法时保留原配置
+    """
+    path = config.path
+    try:
+        last_mtime = os.stat(path).st_mtime
+    except OSError:
+        last_mtime = None
+    log(f"[配置] 监视 {path} 的修改，每 {interval:g} 秒检查一次")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            new_config = load(path)
+        except ConfigError as e:
+            log(f"[配置] 修改后的配置不合法，继续使用原配置: {e}")
+            continue
+        applied, needs_restart = config.apply_reload(new_config)
+        if applied:
+            log(f"[配置] 已热加载: {', '.join(sorted(applied))}")
+        if needs_restart:
+            log(f"[配置] 以下修改需要重启后生效: {', '.join(sorted(needs_restart))}")
@@ -0,0 +1,161 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from utils import log, get_base_path
+
+# 当前这次登录的追踪器，未开启时为 None
+_current = None
+
+
+class Tracer:
+    """
+    记录一次登录中各阶段的起止时间，结束时写成 Chrome Trace 格式的 JSON，
+    可直接拖进 chrome://tracing 或 https://ui.perfetto.dev 查看
+    profile 为 True 时每个阶段单独用 cProfile 采样 (同一时刻只采一个阶段，嵌套阶段只采最外层)，结果写在追踪文件旁边；
+    trace_memory 为 True 时用 tracemalloc 记录每个阶段前后的 Python 内存，在时间线上画成曲线
+    """
+
+    def __init__(self, path, profile=False, trace_memory=False):
+        self.path = path
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = set()
+        self._profiling = False
+        self._profile_seq = 0
+        self._started_tracemalloc = False
+        if trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+
+    def _now_us(self):
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': thread.ident,
+                                     'args': {'name': thread.name}})
+            self._events.append(dict(event, pid=self._pid, tid=thread.ident))
+
+    def _record_memory(self):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        self._add({'name': 'Python 内存 (KB)', 'ph': 'C', 'ts': self._now_us(),
+                   'args': {'current': current // 1024, 'peak': peak // 1024}})
+        return current
+
+    @contextmanager
+    def span(self, name, **args):
+        profiler = None
+        if self.profile:
+            with self._lock:
+                if not self._profiling:
+                    self._profiling = True
+                    self._profile_seq += 1
+                    seq = self._profile_seq
+                    import cProfile
+                    profiler = cProfile.Profile()
+        mem_before = self._record_memory() if self.trace_memory else None
+        if profiler is not None:
+            profiler.enable()
+        start = self._now_us()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            end = self._now_us()
+            if profiler is not None:
+                profiler.disable()
+                self._dump_profile(profiler, seq, name)
+                with self._lock:
+                    self._profiling = False
+            if mem_before is not None:
+                args['memory_delta_kb'] = (self._record_memory() - mem_before) // 1024
+            self._add({'name': name, 'ph': 'X', 'ts': start, 'dur': end - start, 'args': args})
+
+    def _dump_profile(self, profiler, seq, name):
+        safe_name = re.sub(r'[\\/:*?"<>|\s]+', '_', name)
+        path = f"{os.path.splitext(self.path)[0]}.{seq:02d}.{safe_name}.prof"
+        try:
+            profiler.dump_stats(path)
+        except OSError as e:
+            log(f"[追踪] 写入 {path} 失败: {e}")
+
+    def save(self):
+        with self._lock:
+            events = list(self._events)
+        data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            log(f"[追踪] 已写入 {self.path}")
+        except OSError as e:
+            log(f"[追踪] 写入 {self.path} 失败: {e}")
+
+    def close(self):
+        self.save()
+        if self._started_tracemalloc:
+            import tracemalloc
+            tracemalloc.stop()
+
+
+def start_run(config):
+    """
+    开始记录一次登录，配置了 trace_dir 才开启，返回追踪器 (未开启返回 None)
+    """
+    global _current
+    trace_dir = config.get('trace_dir')
+    if not trace_dir:
+        _current = None
+        return None
+    if not os.path.isabs(trace_dir):
+        trace_dir = os.path.join(get_base_path(), trace_dir)
+    os.makedirs(trace_dir, exist_ok=True)
+    # 带上毫秒和进程号：常驻服务定时登录和手动 /run 可能在同一秒开始，不能互相覆盖
+    root = os.path.join(trace_dir, f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]}_{os.getpid()}")
+    path = f"{root}.json"
+    seq = 1
+    while os.path.exists(path):
+        seq += 1
+        path = f"{root}_{seq}.json"
+    _current = Tracer(path, profile=config.get('trace_cprofile', False),
+                      trace_memory=config.get('trace_tracemalloc', False))
+    return _current
+
+
+def finish_run():
+    global _current
+    tracer, _current = _current, None
+    if tracer is not None:
+        tracer.close()
+
+
+def span(name, **args):
+    """
+    记录一个阶段，未开启追踪时什么都不做；可以在任意线程里使用
+    """
+    tracer = _current
+    return tracer.span(name, **args) if tracer is not None else nullcontext()
+
+
+def counter(name, **values):
+    """
+    在时间线上记一个数值 (如浏览器内存)，查看时显示为曲线；未开启追踪时什么都不做
+    """
+    tracer = _current
+    if tracer is not None:
+        tracer._add({'name': name, 'ph': 'C', 'ts': tracer._now_us(), 'args': values})
@@ -0,0 +1,344 @@
+import asyncio
+import socket
+import ssl
+import time
+import weakref
+from collections import deque
+from metrics import Counter, Gauge, Histogram
+from utils import log, INFO
+
+UPSTREAM_CONNECT_SECONDS = Histogram(
+    'ukey_proxy_upstream_connect_seconds', '到 Ukey 主机的 TCP 建连耗时')
+UPSTREAM_TLS_HANDSHAKE_SECONDS = Histogram(
+    'ukey_proxy_upstream_tls_handshake_seconds', '到 Ukey 主机的 TLS 握手耗时', ['resumed'])
+UPSTREAM_CONNECT_ERRORS = Counter(
+    'ukey_proxy_upstream_connect_errors_total', '连接 Ukey 主机失败次数')
+POOL_ACQUIRE = Counter(
+    'ukey_proxy_pool_acquire_total', '从预连接池取连接的次数，hit 为直接取到空闲连接', ['result'])
+UPSTREAM_HEALTHY = Gauge(
+    'ukey_proxy_upstream_healthy', '各 Ukey 主机当前是否可用', ['host'])
+UPSTREAM_RTT_SECONDS = Gauge(
+    'ukey_proxy_upstream_rtt_seconds', '各 Ukey 主机 TCP 建连耗时的滑动平均', ['host'])
+UPSTREAM_FAILOVER = Counter(
+    'ukey_proxy_upstream_failover_total', '连接首选 Ukey 主机失败、改连下一台的次数')
+
+# RTT 滑动平均里新样本的权重
+RTT_ALPHA = 0.3
+
+
+def log_pool(msg, level=INFO):
+    log(f"[Proxy] {msg}", level)
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    会记住每个远程主机最近一次 TLS 会话的客户端上下文
+    asyncio 建连时不能传 session 参数，这里在 wrap_bio 时自动带上，新连接即可走会话恢复 (简化握手)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+    def remember_session(self, host, ssl_object):
+        """
+        保存连接上的 TLS 会话供下次恢复；TLS 1.3 的会话票据在握手后才下发，所以用完连接时再存一次
+        """
+        if ssl_object is None:
+            return
+        session = ssl_object.session
+        if session is not None:
+            self.sessions[host] = session
+
+
+def create_client_ssl_context():
+    """
+    连接机器 B 用的 SSL 上下文：不校验证书 (我们是直连 IP)，并支持会话恢复
+    """
+    ctx = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+class UpstreamPool:
+    """
+    到 Ukey 主机的预连接池
+    - 后台预先建立 size 个已完成 TCP + TLS 握手的空闲连接，浏览器连进来时直接取用
+    - WebSocket 连接有状态，取出后不再归还，池子会在后台补齐
+    - 空闲超过 idle_ttl 秒或已被对端关闭的连接会被丢弃重建
+    - size 为 0 时不预连接，每次现连 (与原来的行为一致)
+    """
+
+    def __init__(self, target_ip, target_port, ssl_ctx, size=0, idle_ttl=60):
+        self.target_ip = target_ip
+        self.target_port = target_port
+        self.ssl_ctx = ssl_ctx
+        self.size = size
+        self.idle_ttl = idle_ttl
+        # 空闲连接：(reader, writer, 建立时间)
+        self._idle = deque()
+        self._wake = None
+        self._task = None
+        # 健康状态和 TCP 建连耗时，由实际建连和 UpstreamGroup 的探测共同更新
+        self.healthy = True
+        self.rtt = None
+        self.label = f"[{target_ip}]:{target_port}" if ':' in target_ip else f"{target_ip}:{target_port}"
+        # 实际建连失败后至少这么久不算恢复：探测只测 TCP，连得上不代表 TLS 和 Ukey 助手正常
+        self.failure_cooldown = 0
+        self._down_until = 0
+        UPSTREAM_HEALTHY.labels(self.label).set(1)
+
+    def record_success(self, rtt, probe=False):
+        if probe and time.monotonic() < self._down_until:
+            return
+        self.rtt = rtt if self.rtt is None else self.rtt * (1 - RTT_ALPHA) + rtt * RTT_ALPHA
+        UPSTREAM_RTT_SECONDS.labels(self.label).set(round(self.rtt, 6))
+        if not self.healthy:
+            log_pool(f"Ukey 主机 {self.label} 恢复可用")
+        self.healthy = True
+        UPSTREAM_HEALTHY.labels(self.label).set(1)
+
+    def record_failure(self, reason, probe=False):
+        if not probe:
+            self._down_until = time.monotonic() + self.failure_cooldown
+        if self.healthy:
+            log_pool(f"Ukey 主机 {self.label} 不可用: {reason}")
+        self.healthy = False
+        UPSTREAM_HEALTHY.labels(self.label).set(0)
+
+    async def probe(self, timeout):
+        """
+        只建一次 TCP 连接测健康和耗时，不做 TLS 握手，不给 Ukey 助手增加负担
+        """
+        start = time.monotonic()
+        try:
+            sock = await asyncio.wait_for(self._connect_tcp(), timeout)
+        except asyncio.TimeoutError:
+            self.record_failure(f"{timeout} 秒内未连上", probe=True)
+            return
+        except OSError as e:
+            self.record_failure(e, probe=True)
+            return
+        sock.close()
+        self.record_success(time.monotonic() - start, probe=True)
+
+    def start(self):
+        if self.size <= 0:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._maintain())
+        log_pool(f"上游连接池已启用: {self.size} 个预连接, 空闲超时 {self.idle_ttl} 秒")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._idle:
+            _, writer, _ = self._idle.popleft()
+            writer.close()
+
+    async def acquire(self):
+        """
+        取一条到 Ukey 主机的连接，返回 (reader, writer)，调用方负责关闭
+        """
+        while self._idle:
+            reader, writer, created = self._idle.popleft()
+            if self._is_healthy(reader, writer, created):
+                self._notify()
+                POOL_ACQUIRE.labels('hit').inc()
+                return reader, writer
+            writer.close()
+
+        self._notify()
+        POOL_ACQUIRE.labels('miss').inc()
+        return await self.open_connection()
+
+    def release(self, writer):
+        """
+        连接用完后调用，记下 TLS 会话供后续连接恢复
+        """
+        self.remember_session(writer)
+
+    def remember_session(self, writer):
+        if isinstance(self.ssl_ctx, ResumingSSLContext):
+            self.ssl_ctx.remember_session(self.target_ip, writer.get_extra_info('ssl_object'))
+
+    async def open_connection(self):
+        # 先单独建 TCP 连接再做 TLS 握手，两段耗时分别计入指标
+        try:
+            start = time.monotonic()
+            sock = await self._connect_tcp()
+            connected = time.monotonic()
+            # SNI 用 target_ip，会话也按它保存
+            reader, writer = await asyncio.open_connection(
+                sock=sock, ssl=self.ssl_ctx, server_hostname=self.target_ip
+            )
+        except Exception as e:
+            UPSTREAM_CONNECT_ERRORS.inc()
+            self.record_failure(e)
+            raise
+
+        ssl_object = writer.get_extra_info('ssl_object')
+        resumed = bool(ssl_object is not None and ssl_object.session_reused)
+        UPSTREAM_CONNECT_SECONDS.observe(connected - start)
+        self.record_success(connected - start)
+        UPSTREAM_TLS_HANDSHAKE_SECONDS.labels('yes' if resumed else 'no').observe(time.monotonic() - connected)
+        self.remember_session(writer)
+        return reader, writer
+
+    async def _connect_tcp(self):
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(self.target_ip, self.target_port, type=socket.SOCK_STREAM)
+        last_exc = None
+        for family, type_, proto, _, address in infos:
+            sock = socket.socket(family, type_, proto)
+            try:
+                sock.setblocking(False)
+                await loop.sock_connect(sock, address)
+                return sock
+            except OSError as e:
+                sock.close()
+                last_exc = e
+            except BaseException:
+                sock.close()
+                raise
+        raise last_exc or OSError(f"无法解析地址 {self.target_ip}")
+
+    def _is_healthy(self, reader, writer, created):
+        if time.monotonic() - created > self.idle_ttl:
+            return False
+        # 对端关闭或出错时 transport 会进入 closing 状态
+        return not writer.is_closing() and not reader.at_eof() and reader.exception() is None
+
+    def _notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _maintain(self):
+        while True:
+            self._wake.clear()
+
+            # 丢弃过期或已断开的空闲连接
+            for _ in range(len(self._idle)):
+                reader, writer, created = self._idle.popleft()
+                if self._is_healthy(reader, writer, created):
+                    self._idle.append((reader, writer, created))
+                else:
+                    writer.close()
+
+            # 补齐到目标数量
+            while len(self._idle) < self.size:
+                try:
+                    reader, writer = await self.open_connection()
+                except Exception as e:
+                    log_pool(f"预连接 Ukey 主机失败 ({self.target_ip}:{self.target_port}) : {e}")
+                    break
+                self._idle.append((reader, writer, time.monotonic()))
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(self.idle_ttl / 2, 1))
+            except asyncio.TimeoutError:
+                pass
+
+
+class UpstreamGroup:
+    """
+    多台 Ukey 主机：每台一个 UpstreamPool，用法和单个 UpstreamPool 相同 (acquire / release / start / close)
+    - 后台每 probe_interval 秒探测各主机的 TCP 建连耗时，实际建连的结果也计入
+    - acquire 按 “可用的在前、建连耗时短的在前” 依次尝试，每台最多等 connect_timeout 秒，失败立即换下一台
+    - 全部标记为不可用时仍会逐台尝试，避免探测误判导致完全不可用
+    - 实际建连失败的主机在 3 个探测周期内不会因为探测成功而恢复，避免反复被选中
+    只有一台主机时不做探测，行为与单个 UpstreamPool 相同 (另加建连超时)
+    """
+
+    def __init__(self, pools, probe_interval=10, probe_timeout=2, connect_timeout=5):
+        self.pools = list(pools)
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.connect_timeout = connect_timeout
+        # 连接 -> 它所属的主机，release 时按主机记 TLS 会话
+        self._owners = weakref.WeakKeyDictionary()
+        self._probe_task = None
+        for pool in self.pools:
+            pool.failure_cooldown = probe_interval * 3
+
+    def apply_config(self, config):
+        """
+        按配置更新探测和建连参数，热加载时也调用
+        """
+        self.probe_interval = float(config.get('proxy_probe_interval_seconds', 10))
+        self.probe_timeout = float(config.get('proxy_probe_timeout_seconds', 2))
+        self.connect_timeout = float(config.get('proxy_upstream_connect_timeout_seconds', 5))
+        for pool in self.pools:
+            pool.idle_ttl = float(config.get('proxy_pool_idle_ttl_seconds', 60))
+            pool.failure_cooldown = self.probe_interval * 3
+
+    def describe(self):
+        return ", ".join(pool.label for pool in self.pools)
+
+    def start(self):
+        for pool in self.pools:
+            pool.start()
+        if len(self.pools) > 1 and self.probe_interval > 0:
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+            log_pool(f"Ukey 主机: {self.describe()}，每 {self.probe_interval} 秒探测一次，优先连接最快的可用主机")
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+        for pool in self.pools:
+            await pool.close()
+
+    def ranked(self):
+        # 没测过耗时的排在测过的后面
+        return sorted(self.pools, key=lambda pool: (not pool.healthy, pool.rtt is None, pool.rtt or 0))
+
+    async def acquire(self):
+        """
+        取一条到最快可用主机的连接，返回 (reader, writer)，调用方负责关闭
+        """
+        last_exc = None
+        for index, pool in enumerate(self.ranked()):
+            if index:
+                UPSTREAM_FAILOVER.inc()
+                log_pool(f"改连 Ukey 主机 {pool.label}")
+            try:
+                reader, writer = await asyncio.wait_for(pool.acquire(), self.connect_timeout or None)
+            except asyncio.TimeoutError:
+                pool.record_failure(f"{self.connect_timeout} 秒内未连上")
+                last_exc = OSError(f"连接 {pool.label} 超时")
+                continue
+            except Exception as e:
+                last_exc = e
+                continue
+            self._owners[writer] = pool
+            return reader, writer
+        raise last_exc or OSError("未配置 Ukey 主机")
+
+    def release(self, writer):
+        pool = self._owners.pop(writer, None)
+        if pool is not None:
+            pool.release(writer)
+
+    async def _probe_loop(self):
+        while True:
+            if self.probe_interval > 0:
+                await asyncio.gather(*(pool.probe(self.probe_timeout) for pool in self.pools))
+            # 探测间隔可能被热加载修改为 0 (暂停探测)
+            await asyncio.sleep(self.probe_interval or 10)
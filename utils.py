@@ -1,41 +1,202 @@
+import atexit
 import ipaddress
 import os
+import queue
 import random
 import sys
 import subprocess
-import json
+import threading
 from datetime import datetime, timedelta
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization
+from functools import lru_cache
 
 
+@lru_cache(maxsize=None)
 def get_base_path():
-    """获取基础路径"""
+    """获取基础路径 (进程内不会变，只算一次)"""
     if getattr(sys, 'frozen', False):
         return os.path.dirname(sys.executable)
     else:
         return os.path.dirname(os.path.abspath(__file__))
 
-def log(content):
+# 日志级别
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_LEVEL_NAMES = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+
+
+class LogWriter:
+    """
+    后台日志写入线程
+    - log() 只负责把消息放进队列，打印和写文件都在后台线程完成，不阻塞调用方 (包括代理的事件循环)
+    - 日志文件保持打开，每次把队列里积压的消息合并成一次写入
+    - 文件超过 max_bytes 或创建超过 rotate_days 天时轮转为 run_log.txt.1 ... run_log.txt.N
+    """
+    BATCH_SIZE = 500
+
+    def __init__(self, path, level=DEBUG, max_bytes=10 * 1024 * 1024, backup_count=5, rotate_days=0):
+        self.path = path
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_days = rotate_days
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._opened_at = None
+        # 轮转失败后从这个位置重新计算大小，避免每次写入都重试
+        self._size_offset = 0
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, msg):
+        self._queue.put(msg)
+
+    def flush(self, timeout=5):
+        """等待队列中已有的日志全部写完"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = [item for item in batch if isinstance(item, str)]
+            if lines:
+                text = "\n".join(lines) + "\n"
+                try:
+                    print(text, end='', flush=True)
+                except Exception:
+                    pass
+                try:
+                    self._write_file(text)
+                except Exception as e:
+                    print(f"写入日志文件失败: {e}")
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write_file(self, text):
+        if self._file is None:
+            self._open()
+        elif self._should_rotate():
+            self._rotate()
+        self._file.write(text)
+        self._file.flush()
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        # 每次运行都在追加，修改时间会一直往后推；Windows 轮转后重建同名文件又会沿用旧的创建时间，
+        # 所以文件开始写入的时间单独记在 run_log.txt.start 里
+        self._opened_at = None
+        if os.path.getsize(self.path) > 0:
+            try:
+                with open(self._start_path, 'r', encoding='utf-8') as f:
+                    self._opened_at = datetime.fromtimestamp(float(f.read().strip()))
+            except (OSError, ValueError):
+                pass
+        if self._opened_at is None:
+            self._mark_started()
+
+    @property
+    def _start_path(self):
+        return self.path + '.start'
+
+    def _mark_started(self):
+        self._opened_at = datetime.now()
+        try:
+            with open(self._start_path, 'w', encoding='utf-8') as f:
+                f.write(str(self._opened_at.timestamp()))
+        except OSError:
+            pass
+
+    def _should_rotate(self):
+        if self.max_bytes and self._file.tell() - self._size_offset >= self.max_bytes:
+            return True
+        if self.rotate_days and datetime.now() - self._opened_at >= timedelta(days=self.rotate_days):
+            return True
+        return False
+
+    def _rotate(self):
+        self._file.close()
+        rotated = True
+        try:
+            if self.backup_count > 0:
+                for i in range(self.backup_count - 1, 0, -1):
+                    src = f"{self.path}.{i}"
+                    if os.path.exists(src):
+                        os.replace(src, f"{self.path}.{i + 1}")
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        except OSError:
+            # 文件被其他进程 (如代理工作进程) 占用时本次不轮转，继续追加
+            rotated = False
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if rotated:
+            self._mark_started()
+        else:
+            # 轮转失败时推迟一个周期再试，而不是每次写入都重试
+            self._opened_at = datetime.now()
+        self._size_offset = 0 if rotated else self._file.tell()
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    global _log_writer
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                _log_writer = LogWriter(os.path.join(get_base_path(), 'run_log.txt'))
+                atexit.register(_log_writer.flush)
+    return _log_writer
+
+
+def configure_log(config):
+    """
+    按配置设置日志级别和轮转策略，读到配置后调用一次即可
+    """
+    writer = get_log_writer()
+    level = str(config.get('log_level', 'DEBUG')).upper()
+    writer.level = _LEVEL_NAMES.get(level, DEBUG)
+    writer.max_bytes = int(float(config.get('log_max_mb', 10)) * 1024 * 1024)
+    writer.backup_count = int(config.get('log_backup_count', 5))
+    writer.rotate_days = float(config.get('log_rotate_days', 0))
+
+
+def log_enabled(level):
+    return level >= get_log_writer().level
+
+
+def log(content, level=INFO):
     """公用日志方法"""
+    writer = get_log_writer()
+    if level < writer.level:
+        return
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    msg = f"[{timestamp}] {content}"
-    print(msg)
-    log_path = os.path.join(get_base_path(), 'run_log.txt')
-    with open(log_path, 'a', encoding='utf-8') as f:
-        f.write(msg + "\n")
+    writer.write(f"[{timestamp}] {content}")
 
 def load_config():
-    """公用配置读取"""
-    config_path = os.path.join(get_base_path(), 'config.json')
-    if not os.path.exists(config_path):
-        log(f"错误：找不到配置文件 {config_path}")
+    """
+    公用配置读取：返回进程内共用的、校验过的配置 (settings.Config)，配置缺失或不合法时记日志并返回 None
+    """
+    from settings import ConfigError, get_config
+    try:
+        return get_config()
+    except ConfigError as e:
+        for problem in e.problems:
+            log(f"配置错误: {problem}")
         return None
-    with open(config_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
 
 
 def generate_self_signed_cert(cert_dir="certs"):
@@ -55,6 +216,12 @@ def generate_self_signed_cert(cert_dir="certs"):
         return ca_cert_path, server_cert_path, server_key_path
 
     log("正在生成伪装证书 (ECC-256)...")
+    # cryptography 导入较慢，只在真正需要生成证书时才导入
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives import serialization
 
     # =========================================================================
     # 1. 生成 CA 证书 (模仿 pawdroot)
@@ -0,0 +1,284 @@
+"""
+抓包回放工具：按抓包文件 (proxy_capture_file) 里记录的时间和顺序，把浏览器发出的报文重新发一遍
+
+两种目标：
+    python ws_replay.py capture.bin --target 127.0.0.1:11111   # 回放到正在运行的代理 (或真实 Ukey 助手)
+    python ws_replay.py capture.bin                            # 本地替身：按抓包里的 Ukey 主机返回内容应答
+    python ws_replay.py capture.bin --through-proxy            # 本地替身前面再挂一个进程内的 wsproxy
+
+--speed 控制回放速度：1 为原速，10 为 10 倍速，0 为不等待、尽快发送。
+注意抓包里的口令已脱敏，回放到真实 Ukey 时涉及口令校验的请求会失败。
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import ssl
+import tempfile
+import time
+
+import utils
+import wsproxy
+from bench_wsproxy import encode_frame, read_frame, percentile, free_port, wait_port, WS_GUID
+from capture import CaptureReader, DIRECTION_UP
+from utils import configure_log, generate_self_signed_cert
+from wsframe import OP_HTTP, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG
+
+# 回放的消息类型，控制帧由两端的 WebSocket 实现自行处理
+_DATA_OPCODES = (OP_TEXT, OP_BINARY)
+# 替身据此找到对应的录制连接，代理会原样转发这个请求头
+REPLAY_CONN_HEADER = b'x-replay-conn'
+
+
+class ReplayConnection:
+    """
+    一条录制下来的浏览器连接：握手路径，以及按时间排序的双向消息
+    """
+
+    def __init__(self, conn_id):
+        self.conn_id = conn_id
+        self.path = '/'
+        self.up = []    # [(录制时间, opcode, payload)]
+        # 第 i 个元素为第 i 条请求之后 Ukey 主机返回的消息，第 0 个为第一条请求之前主动推送的消息
+        self.down = [[]]
+
+    def add(self, record):
+        # 直接保存指向文件映射的 memoryview，不把整个抓包复制进内存；读取器关闭后映射由这些切片保持
+        payload = record.payload
+        if record.length and not payload:
+            # 过长或被压缩的消息没有记录内容，用同样长度的占位数据代替
+            payload = bytes(record.length)
+
+        if record.opcode == OP_HTTP:
+            if record.direction == DIRECTION_UP:
+                parts = bytes(payload).decode('latin-1').split()
+                if len(parts) >= 2:
+                    self.path = parts[1]
+            return
+        if record.opcode not in _DATA_OPCODES:
+            return
+
+        if record.direction == DIRECTION_UP:
+            self.up.append((record.timestamp, record.opcode, payload))
+            self.down.append([])
+        else:
+            self.down[-1].append((record.opcode, payload))
+
+
+def load_capture(path):
+    connections = {}
+    first_timestamp = None
+    with CaptureReader(path) as reader:
+        for record in reader:
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            conn = connections.get(record.conn_id)
+            if conn is None:
+                conn = connections[record.conn_id] = ReplayConnection(record.conn_id)
+            conn.add(record)
+    return connections, first_timestamp
+
+
+# ---------------------------------------------------------------------------
+# 本地替身：按录制内容应答
+# ---------------------------------------------------------------------------
+
+async def stand_in_handler(reader, writer, connections):
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+        key = None
+        conn = None
+        for line in request.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'sec-websocket-key':
+                key = value.strip()
+            elif name == REPLAY_CONN_HEADER:
+                conn = connections.get(int(value.strip()))
+        if key is None:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+        replies = conn.down if conn is not None else [[]]
+        for opcode, payload in replies[0]:
+            writer.write(encode_frame(payload, opcode))
+        index = 0
+        while True:
+            opcode, payload = await read_frame(reader)
+            if opcode == OP_CLOSE:
+                writer.write(encode_frame(payload, OP_CLOSE))
+                break
+            if opcode == OP_PING:
+                writer.write(encode_frame(payload, OP_PONG))
+                continue
+            index += 1
+            if conn is None:
+                # 不认识的连接就回显
+                writer.write(encode_frame(payload, opcode))
+            elif index < len(replies):
+                for reply_opcode, reply in replies[index]:
+                    writer.write(encode_frame(reply, reply_opcode))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+# ---------------------------------------------------------------------------
+# 回放客户端
+# ---------------------------------------------------------------------------
+
+async def replay_connection(host, port, conn, start_at, first_timestamp, speed, stats):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+
+    loop = asyncio.get_running_loop()
+    if conn.up and speed:
+        # 和录制时一样，在第一条请求之前建立连接
+        await asyncio.sleep(max(0.0, start_at + (conn.up[0][0] - first_timestamp) / speed - loop.time()))
+
+    try:
+        reader, writer = await asyncio.open_connection(host, port, ssl=ctx)
+    except OSError as e:
+        stats['errors'].append(f"连接 {conn.conn_id}: {e}")
+        return
+    key = base64.b64encode(os.urandom(16))
+    writer.write(f"GET {conn.path} HTTP/1.1\r\nHost: {host}:{port}\r\n".encode('latin-1') +
+                 b'Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Version: 13\r\n'
+                 b'Sec-WebSocket-Key: ' + key + b'\r\n' +
+                 REPLAY_CONN_HEADER + f": {conn.conn_id}\r\n\r\n".encode('latin-1'))
+    await reader.readuntil(b'\r\n\r\n')
+
+    # 每条请求发出的时间，收到下一条应答时计算延迟
+    sent_at = []
+    received = [0]
+
+    async def receive():
+        answered = 0
+        while True:
+            opcode, _ = await read_frame(reader)
+            if opcode == OP_CLOSE:
+                return
+            if opcode not in _DATA_OPCODES:
+                continue
+            stats['received'] += 1
+            received[0] += 1
+            if answered < len(sent_at):
+                stats['latencies'].append(time.perf_counter() - sent_at[answered])
+                answered = len(sent_at)
+
+    receiver = asyncio.create_task(receive())
+    try:
+        for timestamp, opcode, payload in conn.up:
+            if speed:
+                delay = start_at + (timestamp - first_timestamp) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent_at.append(time.perf_counter())
+            writer.write(encode_frame(payload, opcode, mask=True))
+            await writer.drain()
+            stats['sent'] += 1
+
+        # 等最后一条请求的应答 (若录制里有)
+        expected = sum(len(replies) for replies in conn.down)
+        deadline = loop.time() + 5
+        while received[0] < expected and loop.time() < deadline and not receiver.done():
+            await asyncio.sleep(0.01)
+        writer.write(encode_frame(b'', OP_CLOSE, mask=True))
+        try:
+            await asyncio.wait_for(receiver, 5)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        stats['errors'].append(f"连接 {conn.conn_id}: {e}")
+    finally:
+        receiver.cancel()
+        writer.close()
+
+
+async def replay(args):
+    connections, first_timestamp = load_capture(args.capture)
+    if not connections:
+        print("抓包文件里没有记录")
+        return
+    messages = sum(len(conn.up) for conn in connections.values())
+    last_timestamp = max((conn.up[-1][0] for conn in connections.values() if conn.up), default=first_timestamp)
+    print(f"抓包: {len(connections)} 个连接, {messages} 条请求, 录制时长 {last_timestamp - first_timestamp:.3f} s")
+
+    servers = []
+    proxy_task = None
+    if args.target:
+        host, port = args.target.rsplit(':', 1)
+        port = int(port)
+        label = f"target {args.target}"
+    else:
+        work_dir = tempfile.mkdtemp(prefix='ws_replay_')
+        # 替身和代理都用临时目录里的证书，不动程序目录下的 certs
+        utils.get_base_path = wsproxy.get_base_path = lambda: work_dir
+        _, cert_path, key_path = generate_self_signed_cert(os.path.join(work_dir, 'certs'))
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(cert_path, key_path)
+        stand_in = await asyncio.start_server(
+            lambda r, w: stand_in_handler(r, w, connections), '127.0.0.1', 0, ssl=server_ctx)
+        servers.append(stand_in)
+        host, port = '127.0.0.1', stand_in.sockets[0].getsockname()[1]
+        label = 'stand-in'
+        if args.through_proxy:
+            proxy_port = free_port()
+            config = {'proxy_relay_mode': args.relay_mode, 'proxy_log_payload': False}
+            proxy_task = asyncio.create_task(wsproxy.start_server_async(proxy_port, host, port, config))
+            await wait_port(proxy_port)
+            port = proxy_port
+            label = f"proxy/{args.relay_mode} -> stand-in"
+
+    stats = {'sent': 0, 'received': 0, 'latencies': [], 'errors': []}
+    loop = asyncio.get_running_loop()
+    start_at = loop.time()
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        replay_connection(host, port, conn, start_at, first_timestamp, args.speed, stats)
+        for conn in connections.values()
+    ])
+    elapsed = time.perf_counter() - started
+
+    if proxy_task is not None:
+        proxy_task.cancel()
+        try:
+            await proxy_task
+        except asyncio.CancelledError:
+            pass
+    for server in servers:
+        server.close()
+
+    latencies = sorted(stats['latencies'])
+    print(f"目标: {label}, 速度: {'尽快' if not args.speed else f'{args.speed}x'}")
+    print(f"发送: {stats['sent']}, 收到: {stats['received']}, 回放耗时: {elapsed:.3f} s")
+    print(f"应答延迟 p50: {percentile(latencies, 50) * 1000:.3f} ms, "
+          f"p99: {percentile(latencies, 99) * 1000:.3f} ms, "
+          f"max: {latencies[-1] * 1000 if latencies else 0:.3f} ms")
+    for error in stats['errors']:
+        print(f"错误: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wsproxy 抓包回放')
+    parser.add_argument('capture', help='抓包文件 (proxy_capture_file)')
+    parser.add_argument('--target', help='回放目标 host:port，不填则启动本地替身')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放倍速，0 为不等待')
+    parser.add_argument('--through-proxy', action='store_true', help='本地替身前面挂一个进程内的 wsproxy')
+    parser.add_argument('--relay-mode', default=wsproxy.RELAY_MODE_STREAM,
+                        choices=[wsproxy.RELAY_MODE_STREAM, wsproxy.RELAY_MODE_BUFFERED])
+    parser.add_argument('--log-level', default='WARNING', help='代理日志级别')
+    args = parser.parse_args()
+    configure_log({'log_level': args.log_level})
+    asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    main()
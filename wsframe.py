@@ -0,0 +1,212 @@
+from collections import namedtuple
+
+# WebSocket 操作码
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+# 伪操作码：连接开头的 HTTP Upgrade 握手报文
+OP_HTTP = -1
+
+# 超过这个长度的消息只记录长度，不缓存内容
+MAX_LOG_PAYLOAD = 1024 * 1024
+# 小于这个长度时用整数异或，numpy 的调用开销反而更大
+NUMPY_UNMASK_THRESHOLD = 1024
+# numpy 在第一次遇到大消息时才导入，None 为还没尝试过，False 为未安装
+_np = None
+
+_HTTP_PREFIXES = (b'GET ', b'HTTP/')
+_VALID_OPCODES = (OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG)
+
+# opcode: 操作码；payload: 解掩码后的内容，过长或被压缩时为 None；length: 内容长度
+WsFrame = namedtuple('WsFrame', ['opcode', 'payload', 'length'])
+
+
+def _numpy():
+    global _np
+    if _np is None:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np
+
+
+def unmask(payload, mask_key):
+    """
+    对 payload 做 WebSocket 掩码异或，按整块批量计算，不逐字节循环
+    """
+    n = len(payload)
+    if n == 0:
+        return b''
+
+    np = _numpy() if n >= NUMPY_UNMASK_THRESHOLD else None
+    if not np:
+        # 把整段当成一个大整数一次性异或
+        key = (mask_key * (n // 4 + 1))[:n]
+        return (int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')).to_bytes(n, 'little')
+
+    out = bytearray(payload)
+    words = n // 4
+    # 按 4 字节一组视为 uint32 异或，掩码按同样的字节序解释，结果与逐字节一致
+    arr = np.frombuffer(out, dtype=np.uint32, count=words)
+    arr ^= np.frombuffer(mask_key, dtype=np.uint32)[0]
+    for i in range(words * 4, n):
+        out[i] ^= mask_key[i % 4]
+    return bytes(out)
+
+
+class WsFrameParser:
+    """
+    单方向的增量 WebSocket 帧解析器 (仅用于日志和抓包)
+    - 帧被拆在多次 read 里、或一次 read 里有多帧时都能正确切分
+    - 连接开头的 HTTP 握手单独作为 OP_HTTP 返回
+    - 遇到无法识别的数据后置 broken，调用方应回退为只打印长度
+    """
+
+    def __init__(self, max_payload=MAX_LOG_PAYLOAD):
+        self.max_payload = max_payload
+        self.broken = False
+        self._buf = bytearray()
+        self._handshake = True
+        # 超长帧剩余待跳过的字节数
+        self._skip = 0
+        # 分片消息：[opcode, bytearray 或 None, 总长度]
+        self._fragments = None
+
+    def feed(self, data):
+        """
+        喂入新读到的数据，返回其中已完整的消息列表 [WsFrame, ...]
+        """
+        if self.broken:
+            return []
+
+        frames = []
+        buf = self._buf
+        pos = 0
+
+        if self._skip:
+            n = min(self._skip, len(data))
+            self._skip -= n
+            data = data[n:]
+        buf += data
+
+        while pos < len(buf):
+            if self._skip:
+                n = min(self._skip, len(buf) - pos)
+                self._skip -= n
+                pos += n
+                continue
+
+            if self._handshake:
+                if not buf.startswith(_HTTP_PREFIXES, pos):
+                    self._handshake = False
+                    continue
+                end = buf.find(b'\r\n\r\n', pos)
+                if end < 0:
+                    if len(buf) - pos > 64 * 1024:
+                        self._break()
+                        return frames
+                    break
+                line_end = buf.find(b'\r\n', pos)
+                first_line = bytes(buf[pos:line_end])
+                frames.append(WsFrame(OP_HTTP, first_line, end + 4 - pos))
+                pos = end + 4
+                self._handshake = False
+                continue
+
+            consumed = self._parse_frame(buf, pos, frames)
+            if consumed is None:
+                if self.broken:
+                    return frames
+                break
+            pos += consumed
+
+        del buf[:pos]
+        return frames
+
+    def _parse_frame(self, buf, pos, frames):
+        avail = len(buf) - pos
+        if avail < 2:
+            return None
+
+        b0 = buf[pos]
+        b1 = buf[pos + 1]
+        fin = b0 & 0x80
+        # RSV1 表示 permessage-deflate 压缩，内容无法直接解码
+        compressed = b0 & 0x40
+        opcode = b0 & 0x0F
+        masked = b1 & 0x80
+        length = b1 & 0x7F
+
+        if opcode not in _VALID_OPCODES:
+            self._break()
+            return None
+
+        header_len = 2
+        if length == 126:
+            header_len = 4
+        elif length == 127:
+            header_len = 10
+        if masked:
+            header_len += 4
+        if avail < header_len:
+            return None
+
+        if length == 126:
+            length = int.from_bytes(buf[pos + 2:pos + 4], 'big')
+        elif length == 127:
+            length = int.from_bytes(buf[pos + 2:pos + 10], 'big')
+
+        if length > self.max_payload:
+            # 超长帧只记录长度，内容直接跳过，不进缓冲
+            self._skip = length
+            self._emit(frames, opcode, fin, None, length)
+            return header_len
+
+        if avail < header_len + length:
+            return None
+
+        start = pos + header_len
+        payload = buf[start:start + length]
+        if masked:
+            payload = unmask(payload, bytes(buf[start - 4:start]))
+        self._emit(frames, opcode, fin, None if compressed else payload, length)
+        return header_len + length
+
+    def _emit(self, frames, opcode, fin, payload, length):
+        if opcode >= OP_CLOSE:
+            # 控制帧不会分片，且可以夹在分片消息中间
+            frames.append(WsFrame(opcode, payload, length))
+            return
+
+        if opcode != OP_CONTINUATION:
+            if fin:
+                frames.append(WsFrame(opcode, payload, length))
+                return
+            self._fragments = [opcode, None if payload is None else bytearray(payload), length]
+            return
+
+        if self._fragments is None:
+            # 没见过首帧的续帧 (例如从中途开始解析)，原样上报
+            frames.append(WsFrame(opcode, payload, length))
+            return
+
+        frag = self._fragments
+        frag[2] += length
+        if frag[1] is not None:
+            if payload is None or frag[2] > self.max_payload:
+                frag[1] = None
+            else:
+                frag[1] += payload
+        if fin:
+            frames.append(WsFrame(frag[0], None if frag[1] is None else bytes(frag[1]), frag[2]))
+            self._fragments = None
+
+    def _break(self):
+        self.broken = True
+        self._buf.clear()
+        self._fragments = None
@@ -1,133 +1,370 @@
 import asyncio
+import multiprocessing
+import socket
 import ssl
 import os
 import sys
-from utils import log, get_base_path, load_config, generate_self_signed_cert, check_and_install_cert
+import threading
+import time
+from utils import log, log_enabled, configure_log, get_base_path, load_config, generate_self_signed_cert, \
+    check_and_install_cert, DEBUG, INFO
+from wsframe import WsFrameParser, OP_HTTP, OP_TEXT
+from upstream import UpstreamGroup, UpstreamPool, create_client_ssl_context
+from metrics import Counter, Gauge, Histogram, start_metrics_server
+import capture
+
+# 转发模式：stream 为原有的 StreamReader/Writer + pipe() 实现，buffered 为基于 BufferedProtocol 的实现
+RELAY_MODE_STREAM = 'stream'
+RELAY_MODE_BUFFERED = 'buffered'
+
+# 转发方向，同时用作日志前缀
+DIRECTION_UP = "本机->Ukey主机"
+DIRECTION_DOWN = "Ukey主机->本机"
+_DIRECTION_METRIC_LABELS = {DIRECTION_UP: 'up', DIRECTION_DOWN: 'down'}
+_DIRECTION_CAPTURE = {DIRECTION_UP: capture.DIRECTION_UP, DIRECTION_DOWN: capture.DIRECTION_DOWN}
+
+ACTIVE_CONNECTIONS = Gauge('ukey_proxy_active_connections', '当前正在转发的浏览器连接数')
+CONNECTIONS_TOTAL = Counter('ukey_proxy_connections_total', '累计接入的浏览器连接数')
+BYTES_TOTAL = Counter('ukey_proxy_bytes_total', '累计转发字节数，up 为本机->Ukey主机', ['direction'])
+TIME_TO_FIRST_BYTE_SECONDS = Histogram(
+    'ukey_proxy_time_to_first_byte_seconds', '浏览器第一次发出数据到收到 Ukey 主机第一个字节的耗时')
+CONNECTION_DURATION_SECONDS = Histogram(
+    'ukey_proxy_connection_duration_seconds', '浏览器连接的存活时长',
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200))
+# 浏览器侧 TLS 1.2 套件顺序 (TLS 1.3 套件由 OpenSSL 决定)
+SERVER_CIPHERS = 'ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-ECDSA-AES256-GCM-SHA384'
+_server_ssl_ctx_cache = {}
+_client_ssl_ctx = None
+
+IDLE_CLOSED = Counter('ukey_proxy_idle_closed_total', '因空闲超时被关闭的连接数')
+LEAKED_UPSTREAM = Counter('ukey_proxy_leaked_upstream_total', '浏览器侧已断开、被巡检回收的 Ukey 主机连接数')
+
+
+def log_proxy(msg, level=INFO):
+    # 简单的日志输出，为了不和主程序混淆，加个前缀
+    log(f"[Proxy] {msg}", level)
 
 
-def log_proxy(msg):
-    # 简单的日志输出，为了不和主程序混淆，加个前缀
-    log(f"[Proxy] {msg}")
+def set_nodelay(transport):
+    # WebSocket 报文小而频繁，关闭 Nagle 避免小包被攒着延迟发送
+    sock = transport.get_extra_info('socket')
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+class ProxyContext:
+    """
+    一个监听端口下所有连接共享的转发设置：上游连接池、报文日志开关、流控参数，以及连接巡检
+    """
+    REAPER_INTERVAL = 30
+
+    def __init__(self, pool, log_payload=True, write_high=256 * 1024, write_low=64 * 1024,
+                 idle_timeout=0, half_close_timeout=5, recorder=None):
+        self.pool = pool
+        self.log_payload = log_payload
+        # 抓包记录器 (capture.CaptureWriter)，为 None 时不抓包
+        self.recorder = recorder
+        self.write_high = write_high
+        self.write_low = write_low
+        # 连接双向都没有数据超过这么久就关闭，0 为不限制
+        self.idle_timeout = idle_timeout
+        # 一侧半关闭后，最多再等另一侧这么久
+        self.half_close_timeout = half_close_timeout
+        self.connections = set()
+        self._reaper_task = None
+
+    @classmethod
+    def from_config(cls, config, pool):
+        ctx = cls(pool, recorder=open_recorder(config))
+        ctx.apply_config(config)
+        return ctx
+
+    def apply_config(self, config):
+        """
+        按配置更新转发设置，热加载时也调用；新设置对之后建立的连接生效
+        """
+        # 关闭后不再解析 WebSocket 帧，只做转发
+        self.log_payload = config.get('proxy_log_payload', True)
+        self.write_high = int(config.get('proxy_write_buffer_high_kb', 256)) * 1024
+        self.write_low = int(config.get('proxy_write_buffer_low_kb', 64)) * 1024
+        self.idle_timeout = float(config.get('proxy_idle_timeout_seconds', 0))
+        self.half_close_timeout = float(config.get('proxy_half_close_timeout_seconds', 5))
+
+    def apply_write_limits(self, transport):
+        # 写缓冲超过 high 时暂停读取另一侧，降到 low 以下再恢复，单连接内存因此有上限
+        transport.set_write_buffer_limits(high=self.write_high, low=self.write_low)
+
+    def new_connection(self):
+        conn = ProxyConnection(self)
+        self.connections.add(conn)
+        return conn
+
+    def start_reaper(self):
+        self._reaper_task = asyncio.get_running_loop().create_task(self._reap())
+
+    async def stop_reaper(self):
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            try:
+                await self._reaper_task
+            except asyncio.CancelledError:
+                pass
+            self._reaper_task = None
+
+    async def _reap(self):
+        while True:
+            # idle_timeout 可能被热加载修改，每轮重新计算间隔
+            interval = self.REAPER_INTERVAL
+            if self.idle_timeout:
+                interval = min(interval, max(self.idle_timeout / 2, 1))
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for conn in list(self.connections):
+                self._inspect(conn, now)
+
+    def _inspect(self, conn, now):
+        client = conn.client_transport
+        upstream = conn.upstream_transport
+        if client is None:
+            return
+
+        if client.is_closing():
+            if upstream is None or upstream.is_closing():
+                # 两侧都已关闭但处理流程没收尾 (例如任务卡住)，直接结算
+                if conn.suspect:
+                    conn.close()
+                else:
+                    conn.suspect = True
+                return
+            # 浏览器侧已断开、上游还开着，连续两次巡检都如此才算泄漏，避开半关闭的正常收尾
+            if conn.suspect:
+                LEAKED_UPSTREAM.inc()
+                log_proxy("回收泄漏的 Ukey 主机连接")
+                upstream.abort()
+            else:
+                conn.suspect = True
+            return
 
+        conn.suspect = False
+        if self.idle_timeout and now - conn.last_active > self.idle_timeout:
+            IDLE_CLOSED.inc()
+            log_proxy(f"连接空闲超过 {self.idle_timeout:.0f} 秒，关闭")
+            client.close()
+            if upstream is not None:
+                upstream.close()
 
-def decode_ws_payload(data):
+
+class ProxyConnection:
     """
-    尝试解析 WebSocket 帧并提取 Payload 文本
-    仅用于日志打印，不严谨，但能处理大部分短报文
+    单个浏览器连接：两侧的 transport、最近活动时间，以及流量与计时统计 (连接结束时汇总进指标)
     """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.first_up = None
+        self.first_down = None
+        self.client_transport = None
+        self.upstream_transport = None
+        self.suspect = False
+        self.closed = False
+        self.conn_id = ctx.recorder.new_conn_id() if ctx.recorder is not None else 0
+        ACTIVE_CONNECTIONS.inc()
+        CONNECTIONS_TOTAL.inc()
+
+    def attach(self, client_transport=None, upstream_transport=None):
+        for transport in (client_transport, upstream_transport):
+            if transport is not None:
+                self.ctx.apply_write_limits(transport)
+                set_nodelay(transport)
+        if client_transport is not None:
+            self.client_transport = client_transport
+        if upstream_transport is not None:
+            self.upstream_transport = upstream_transport
+
+    def on_data(self, direction_label, nbytes):
+        self.last_active = time.monotonic()
+        BYTES_TOTAL.labels(_DIRECTION_METRIC_LABELS[direction_label]).inc(nbytes)
+        if direction_label == DIRECTION_UP:
+            if self.first_up is None:
+                self.first_up = self.last_active
+        elif self.first_down is None and self.first_up is not None:
+            self.first_down = self.last_active
+            TIME_TO_FIRST_BYTE_SECONDS.observe(self.first_down - self.first_up)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ctx.connections.discard(self)
+        # 兜底：处理流程结束时两侧都必须关掉
+        for transport in (self.client_transport, self.upstream_transport):
+            if transport is not None and not transport.is_closing():
+                transport.close()
+        ACTIVE_CONNECTIONS.dec()
+        CONNECTION_DURATION_SECONDS.observe(time.monotonic() - self.started)
+
+
+def open_recorder(config):
+    """
+    按配置打开抓包记录器，proxy_capture_file 为空时不抓包
+    抓到的报文会先脱敏：配置里的密码、Ukey 口令，以及 JSON 里名字像口令的字段
+    """
+    path = config.get('proxy_capture_file')
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(get_base_path(), path)
+    redactor = capture.Redactor(
+        secrets=(config.get('password'), config.get('ukey_pin')),
+        keys=config.get('proxy_capture_redact_keys', capture.DEFAULT_REDACT_KEYS)
+    )
     try:
-        if len(data) < 2:
-            return None
-
-        # Byte 0: FIN + Opcode
-        # Byte 1: Mask + Payload Len
-        second_byte = data[1]
-
-        # 检查 Mask 位 (第8位)
-        is_masked = (second_byte & 0x80) >> 7
-        payload_len = second_byte & 0x7F
-
-        payload_start = 2
-
-        # 处理长度字段
-        if payload_len == 126:
-            payload_start = 4  # 2 header + 2 length
-        elif payload_len == 127:
-            payload_start = 10  # 2 header + 8 length
-
-        if len(data) < payload_start:
-            return None
-
-        # 提取 Mask Key
-        mask_key = None
-        if is_masked:
-            if len(data) < payload_start + 4:
-                return None
-            mask_key = data[payload_start: payload_start + 4]
-            payload_start += 4
-
-        # 提取 Payload 数据
-        payload = data[payload_start:]
-
-        # 如果有掩码，需要进行异或解密 (XOR unmasking)
-        if is_masked:
-            unmasked_payload = bytearray()
-            for i in range(len(payload)):
-                unmasked_payload.append(payload[i] ^ mask_key[i % 4])
-            payload = unmasked_payload
-
-        # 尝试转为 UTF-8 文本
-        return payload.decode('utf-8')
-
-    except Exception:
-        # 解析失败（可能是分包了，或者是纯二进制帧）
+        return capture.CaptureWriter(path, redactor)
+    except OSError as e:
+        log_proxy(f"抓包文件打开失败，不抓包: {e}")
         return None
 
 
-async def pipe(reader, writer, direction_label):
+class PayloadTap:
+    """
+    单个连接单个方向的报文旁路：用增量解析器切出完整的 WebSocket 消息，交给报文日志和抓包记录器
+    """
+
+    def __init__(self, direction_label, log_payload, recorder=None, conn_id=0):
+        self.direction_label = direction_label
+        self.log_payload = log_payload
+        self.recorder = recorder
+        self.conn_id = conn_id
+        self.parser = WsFrameParser()
+
+    def feed(self, data):
+        if self.parser.broken:
+            # 解析器已无法跟上帧边界，回退到原始打印
+            if self.log_payload:
+                log_proxy(f"[{self.direction_label}] {len(data)} bytes (Raw/Binary)", DEBUG)
+            return
+
+        for frame in self.parser.feed(data):
+            if self.recorder is not None:
+                self.recorder.record(self.conn_id, _DIRECTION_CAPTURE[self.direction_label],
+                                     frame.opcode, frame.length, frame.payload)
+            if self.log_payload:
+                log_frame(frame, self.direction_label)
+
+
+def new_tap(ctx, direction_label, conn):
+    # 每个连接的每个方向各用一个旁路；不记报文日志 (关闭或日志级别高于 DEBUG) 也不抓包时不创建，完全跳过解析
+    log_payload = ctx.log_payload and log_enabled(DEBUG)
+    if not log_payload and ctx.recorder is None:
+        return None
+    return PayloadTap(direction_label, log_payload, ctx.recorder, conn.conn_id)
+
+
+def log_frame(frame, direction_label):
+    """
+    智能日志记录：文本消息打印内容，其余只打印长度
+    """
+    if frame.opcode == OP_HTTP:
+        log_proxy(f"[{direction_label}] (HTTP): {frame.payload.decode('latin-1')}", DEBUG)
+        return
+
+    ws_text = None
+    if frame.opcode == OP_TEXT and frame.payload is not None:
+        try:
+            ws_text = frame.payload.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+
+    if ws_text:
+        # 如果解析成功，打印干净的文本
+        # 去掉换行符方便单行显示
+        clean_text = ws_text.strip().replace('\n', ' ')
+        log_proxy(f"[{direction_label}] (WS-Decoded): {clean_text}", DEBUG)
+    else:
+        # 非文本帧或被压缩，只打印长度
+        log_proxy(f"[{direction_label}] {frame.length} bytes (Raw/Binary, opcode={frame.opcode})", DEBUG)
+
+
+async def pipe(reader, writer, direction_label, tap=None, conn=None):
     """
     将数据从 reader 管道转发到 writer
+    tap 为该方向的 PayloadTap，为 None 时不做报文日志和抓包
+    conn 为所属的 ProxyConnection，用于统计
+    返回 True 表示读到 EOF 后只半关闭了 writer，另一个方向还可以继续传
     """
+    half_closed = False
     try:
         while True:
             # 读取数据
             data = await reader.read(4096)
             if not data:
+                # 能半关闭就只关掉对端的写方向 (TLS 连接不支持，只能整体关闭)
+                if writer.can_write_eof():
+                    writer.write_eof()
+                    half_closed = True
                 break
 
-            # --- 智能日志记录 ---
-            if len(data) > 0:
-                # 尝试解析 WebSocket 协议
-                ws_text = decode_ws_payload(data)
-
-                if ws_text:
-                    # 如果解析成功，打印干净的文本
-                    # 去掉换行符方便单行显示
-                    clean_text = ws_text.strip().replace('\n', ' ')
-                    # 限制日志长度，防止 JSON 太长刷屏，保留前 500 字符
-                    # if len(clean_text) > 500:
-                    #     clean_text = clean_text[:500] + "..."
-                    log_proxy(f"[{direction_label}] (WS-Decoded): {clean_text}")
-                else:
-                    # 解析失败（非文本帧或分片），回退到原始打印
-                    log_proxy(f"[{direction_label}] {len(data)} bytes (Raw/Binary)")
+            if conn is not None:
+                conn.on_data(direction_label, len(data))
+
+            # --- 智能日志记录 / 抓包 ---
+            if tap is not None:
+                tap.feed(data)
 
             # --- 转发数据 (原封不动) ---
+            # 写缓冲超过上限时 drain 会挂起，本方向随之停止读取，形成背压
             writer.write(data)
             await writer.drain()
 
     except Exception as e:
         log_proxy(f"Pipe error {direction_label}: {e}")
     finally:
-        try:
-            writer.close()
-        except:
-            pass
+        if not half_closed:
+            try:
+                writer.close()
+            except:
+                pass
+    return half_closed
 
 
-async def handle_client(client_reader, client_writer, target_ip, target_port, target_ssl_ctx):
+async def handle_client(client_reader, client_writer, ctx):
     """
     处理每一个来自浏览器的连接
     """
+    conn = ctx.new_connection()
+    conn.attach(client_transport=client_writer.transport)
+    remote_writer = None
     try:
         log_proxy("New browser connection received.")
 
-        # 连接到远程机器 B
+        # 连接到远程机器 B (优先从预连接池取)
         # 注意：机器 B 上的 Ukey 也是 SSL 服务，所以需要 SSL 连接
         # server_hostname=None 和 check_hostname=False 极其重要，因为我们在连 IP，且可能不验证 B 的证书
+        pool = ctx.pool
         try:
-            remote_reader, remote_writer = await asyncio.open_connection(
-                target_ip, target_port, ssl=target_ssl_ctx, server_hostname=None
-            )
+            remote_reader, remote_writer = await pool.acquire()
         except Exception as e:
-            log_proxy(f"无法连接到Ukey主机 ({target_ip}:{target_port}) : {e}")
+            log_proxy(f"无法连接到Ukey主机 ({pool.describe()}) : {e}")
             return
+        conn.attach(upstream_transport=remote_writer.transport)
 
         # 创建双向管道
-        task1 = asyncio.create_task(pipe(client_reader, remote_writer, "本机->Ukey主机"))
-        task2 = asyncio.create_task(pipe(remote_reader, client_writer, "Ukey主机->本机"))
+        task1 = asyncio.create_task(
+            pipe(client_reader, remote_writer, DIRECTION_UP, new_tap(ctx, DIRECTION_UP, conn), conn))
+        task2 = asyncio.create_task(
+            pipe(remote_reader, client_writer, DIRECTION_DOWN, new_tap(ctx, DIRECTION_DOWN, conn), conn))
 
         done, pending = await asyncio.wait([task1, task2], return_when=asyncio.FIRST_COMPLETED)
+        if pending and any(task.result() for task in done):
+            # 一侧只是半关闭，给另一侧一点时间把剩余数据传完
+            _, pending = await asyncio.wait(pending, timeout=ctx.half_close_timeout)
+        pool.release(remote_writer)
 
         # 取消剩余的任务
         for task in pending:
@@ -136,47 +373,465 @@ async def handle_client(client_reader, client_writer, target_ip, target_port, ta
     except Exception as e:
         log_proxy(f"Connection handler error: {e}")
     finally:
-        try:
-            client_writer.close()
-        except:
-            pass
+        # 两侧都要关闭，避免远程连接残留
+        for writer in (client_writer, remote_writer):
+            if writer is None:
+                continue
+            try:
+                writer.close()
+            except:
+                pass
+        conn.close()
         log_proxy("Connection closed.")
 
 
-async def start_server_async(local_port, target_ip, target_port):
-    base_path = get_base_path()
+class RelayProtocol(asyncio.BufferedProtocol):
+    """
+    基于 BufferedProtocol 的单向转发端点 (relay_mode = "buffered")
+    - 数据直接读进可复用的接收缓冲区，不再每次 read 都分配新的 bytes
+    - 缓冲区大小按实际读取量自适应伸缩
+    - 同一轮事件循环里收到的多段数据合并成一次 write 发给对端，也不再每次都 await drain()
+    - 对端写缓冲满时暂停本端读取，实现背压
+    """
+    MIN_BUFFER_SIZE = 16 * 1024  # 一个 TLS record 的最大明文长度
+    MAX_BUFFER_SIZE = 256 * 1024
+
+    def __init__(self, direction_label, ctx, tap=None, conn=None):
+        self.direction_label = direction_label
+        self.ctx = ctx
+        self.tap = tap
+        self.conn = conn
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.peer = None
+        self.eof = False
+        self._buffer = bytearray(self.MIN_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        # 待发给对端的数据，flush 时整块交给对端 transport，之后换一个新的
+        self._pending = bytearray()
+        self._flush_scheduled = False
+        self._small_reads = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self._view
+
+    def buffer_updated(self, nbytes):
+        chunk = self._view[:nbytes]
+        if self.conn is not None:
+            self.conn.on_data(self.direction_label, nbytes)
+        if self.tap is not None:
+            self.tap.feed(chunk)
+        self._pending += chunk
+        chunk.release()
+        self._adapt_buffer(nbytes)
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _adapt_buffer(self, nbytes):
+        size = len(self._buffer)
+        if nbytes == size and size < self.MAX_BUFFER_SIZE:
+            # 读满了，说明对端在大块发送 (签名/证书等)，扩大缓冲区
+            self._resize(size * 2)
+        elif nbytes < size // 4 and size > self.MIN_BUFFER_SIZE:
+            # 连续多次小包才收缩，避免来回抖动
+            self._small_reads += 1
+            if self._small_reads >= 8:
+                self._resize(size // 2)
+        else:
+            self._small_reads = 0
+
+    def _resize(self, size):
+        self._small_reads = 0
+        self._view.release()
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if not self._pending or self.peer is None or self.peer.transport is None:
+            return
+        if self.peer.transport.is_closing():
+            self._pending.clear()
+            return
+        data, self._pending = self._pending, bytearray()
+        self.peer.transport.write(data)
+
+    def pause_writing(self):
+        # 本端写缓冲过高，暂停读取对端
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.resume_reading()
+
+    def eof_received(self):
+        self.eof = True
+        self._flush()
+        peer = self.peer
+        if peer is not None and not peer.eof and peer.transport.can_write_eof():
+            # 半关闭：只关掉对端的写方向，本端保持打开等对端把剩余数据传完
+            peer.transport.write_eof()
+            self.loop.call_later(self.ctx.half_close_timeout, self._close_pair)
+            return True
+        # 返回 False 让 transport 自行关闭，随后触发 connection_lost
+        return False
+
+    def _close_pair(self):
+        for transport in (self.transport, self.peer.transport if self.peer else None):
+            if transport is not None and not transport.is_closing():
+                transport.close()
+
+    def connection_lost(self, exc):
+        if exc:
+            log_proxy(f"Pipe error {self.direction_label}: {exc}")
+        # 把剩余数据交给对端后再关闭对端 (close 会先发完写缓冲)
+        self._flush()
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.close()
+        self._view.release()
+
+
+class BrowserRelayProtocol(RelayProtocol):
+    """
+    浏览器侧的转发端点，连接建立后负责从连接池取一条到远程机器 B 的连接
+    """
+
+    def __init__(self, ctx):
+        super().__init__(DIRECTION_UP, ctx)
+        self._connect_task = None
+        self._upstream_writer = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.conn = self.ctx.new_connection()
+        self.conn.attach(client_transport=transport)
+        self.tap = new_tap(self.ctx, DIRECTION_UP, self.conn)
+        log_proxy("New browser connection received.")
+        # 远程连接建立之前先不读浏览器数据
+        transport.pause_reading()
+        self._connect_task = self.loop.create_task(self._connect_upstream())
+
+    async def _connect_upstream(self):
+        pool = self.ctx.pool
+        try:
+            _, remote_writer = await pool.acquire()
+        except Exception as e:
+            log_proxy(f"无法连接到Ukey主机 ({pool.describe()}) : {e}")
+            self.transport.close()
+            return
+
+        if self.transport.is_closing():
+            remote_writer.close()
+            return
+
+        # 池里的连接是 Stream 形式建立的，把 transport 切换到 BufferedProtocol 上
+        upstream = RelayProtocol(DIRECTION_DOWN, self.ctx, new_tap(self.ctx, DIRECTION_DOWN, self.conn), self.conn)
+        remote_writer.transport.set_protocol(upstream)
+        upstream.connection_made(remote_writer.transport)
+        self.conn.attach(upstream_transport=remote_writer.transport)
+        self._upstream_writer = remote_writer
+
+        self.peer = upstream
+        upstream.peer = self
+        self._flush()
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self._connect_task is not None and not self._connect_task.done():
+            self._connect_task.cancel()
+        if self._upstream_writer is not None:
+            self.ctx.pool.release(self._upstream_writer)
+        super().connection_lost(exc)
+        self.conn.close()
+        log_proxy("Connection closed.")
+
 
-    # 1. 准备证书
+def prepare_server_cert(base_path):
+    """
+    准备浏览器侧用的证书，返回 (证书路径, 私钥路径)
+    """
     cert_dir = os.path.join(base_path, 'certs')
+    # 自动检查是否存在，不存在则生成
+    ca_path, cert_path, key_path = generate_self_signed_cert(cert_dir)
+    # 检查是否安装过，没安装过就安装证书
+    check_and_install_cert(cert_dir)
+    return cert_path, key_path
+
+
+def get_server_ssl_context(base_path, curve=None, prepare=True):
+    """
+    浏览器侧的 SSL 上下文，同一进程内缓存复用
+    - 代理重启时不再检查证书、读盘解析
+    - 上下文不变则会话票据密钥不变，浏览器重连时可直接恢复会话，省去完整的 ECDSA 握手
+    prepare 为 False 时只加载已有的证书 (工作进程用，证书由主进程统一生成、安装)
+    """
+    key = (base_path, curve)
+    ctx = _server_ssl_ctx_cache.get(key)
+    if ctx is not None:
+        return ctx
+
+    if prepare:
+        cert_path, key_path = prepare_server_cert(base_path)
+    else:
+        cert_dir = os.path.join(base_path, 'certs')
+        cert_path, key_path = os.path.join(cert_dir, 'server.crt'), os.path.join(cert_dir, 'server.key')
+
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(certfile=cert_path, keyfile=key_path)
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    # 按我们的顺序选套件：证书是 ECDSA，优先 AES-GCM (有硬件加速)
+    ctx.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    ctx.set_ciphers(SERVER_CIPHERS)
+    if curve:
+        # 默认的曲线顺序 X25519 优先，和 Chrome 默认发送的 key share 一致；
+        # 只指定一条浏览器未预先发送的曲线会多一次 HelloRetryRequest 往返
+        ctx.set_ecdh_curve(curve)
+
+    _server_ssl_ctx_cache[key] = ctx
+    return ctx
+
+
+def get_client_ssl_context():
+    """
+    连接机器 B 的 SSL 上下文，同一进程内缓存复用，代理重启后仍能恢复之前的 TLS 会话
+    """
+    global _client_ssl_ctx
+    if _client_ssl_ctx is None:
+        _client_ssl_ctx = create_client_ssl_context()
+    return _client_ssl_ctx
+
+
+def parse_targets(targets, default_port):
+    """
+    解析 Ukey 主机列表，每项为 "ip"、"ip:port"，IPv6 写成 "[::1]:port" 或不带端口的 "::1"，
+    没写端口的用 default_port，返回 [(ip, port)]；写法不对时抛 ValueError
+    """
+    parsed = []
+    for item in targets:
+        text = str(item).strip()
+        if not text:
+            continue
+        if text.startswith('['):
+            host, sep, rest = text[1:].partition(']')
+            if not sep or not host or (rest and not rest.startswith(':')):
+                raise ValueError(f"无法识别的 Ukey 主机地址: {item!r}")
+            port = rest[1:] if rest else None
+        elif text.count(':') > 1:
+            # 不带方括号的 IPv6 地址，冒号都属于地址本身
+            host, port = text, None
+        else:
+            host, sep, port = text.partition(':')
+            port = port if sep else None
+        if port is None:
+            port = default_port
+        elif not port.isdigit():
+            raise ValueError(f"Ukey 主机地址的端口不是数字: {item!r}")
+        port = int(port)
+        if not host or not 0 < port <= 65535:
+            raise ValueError(f"无法识别的 Ukey 主机地址: {item!r}")
+        parsed.append((host, port))
+    return parsed
+
+
+async def start_server_async(local_port, target_ip, target_port, config=None, reuse_port=False, prepare_certs=True):
+    """
+    reuse_port 为 True 时以 SO_REUSEPORT 监听，多个工作进程可共享同一端口，由内核分配连接
+    prepare_certs 为 False 时不生成、安装证书，只加载主进程准备好的证书
+    """
+    config = config or {}
+    relay_mode = config.get('proxy_relay_mode', RELAY_MODE_STREAM)
+
+    # 1. 准备证书，配置 A 机器监听的 SSL 上下文 (Server 端 - 欺骗浏览器用)
     try:
-        # 自动检查是否存在，不存在则生成
-        ca_path, cert_path, key_path = generate_self_signed_cert(cert_dir)
-        # 检查是否安装过，没安装过就安装证书
-        check_and_install_cert(cert_dir)
+        server_ssl_ctx = get_server_ssl_context(get_base_path(), config.get('proxy_tls_curve'), prepare=prepare_certs)
+    except Exception as e:
+        log_proxy(f"证书获取失败: {e}")
+        return
+
+    # 2. 配置连接 B 机器的 SSL 上下文 (Client 端 - 连接真实Ukey服务用)，并准备预连接池
+    client_ssl_ctx = get_client_ssl_context()
+    # 配置了 ukey_proxy_targets 时按其中的多台主机路由，否则只连 target_ip
+    try:
+        targets = parse_targets(config.get('ukey_proxy_targets') or [target_ip], target_port)
+    except ValueError as e:
+        log_proxy(f"代理不启动: {e}")
+        return
+    pool = UpstreamGroup(
+        [UpstreamPool(ip, port, client_ssl_ctx, size=int(config.get('proxy_pool_size', 0))) for ip, port in targets])
+    pool.apply_config(config)
+    ctx = ProxyContext.from_config(config, pool)
+    if hasattr(config, 'on_reload'):
+        # 主程序开启了配置热加载时，修改后的转发、探测设置直接生效
+        def reload_proxy(changed):
+            if any(key.startswith('proxy_') for key in changed):
+                ctx.apply_config(config)
+                pool.apply_config(config)
+        config.on_reload(reload_proxy)
+
+    # 3. 启动监听
+    if relay_mode == RELAY_MODE_BUFFERED:
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: BrowserRelayProtocol(ctx),
+            '0.0.0.0', local_port, ssl=server_ssl_ctx, reuse_port=reuse_port or None
+        )
+    else:
+        server = await asyncio.start_server(
+            lambda r, w: handle_client(r, w, ctx),
+            '0.0.0.0', local_port, ssl=server_ssl_ctx, reuse_port=reuse_port or None
+        )
+
+    log_proxy(f"Listening on 127.0.0.1:{local_port} (SSL, {relay_mode}) -> Forwarding to {pool.describe()}")
+
+    # 4. 可选的指标端点，只监听本机
+    metrics_server = None
+    metrics_port = int(config.get('proxy_metrics_port', 0))
+    if metrics_port:
+        try:
+            metrics_server = await start_metrics_server(metrics_port)
+        except OSError as e:
+            log_proxy(f"指标端点启动失败: {e}")
+
+    pool.start()
+    ctx.start_reaper()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await ctx.stop_reaper()
+        await pool.close()
+        if ctx.recorder is not None:
+            ctx.recorder.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
 
+def _run_event_loop(local_port, target_ip, target_port, config, reuse_port=False, use_uvloop=False, prepare_certs=True):
+    # 启动 asyncio循环
+    # Windows 下 asyncio 的 SelectorEventLoop 某些情况有兼容性问题，ProactorEventLoop 通常更好
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    elif use_uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            log_proxy("使用 uvloop 事件循环")
+        except ImportError:
+            pass
+
+    try:
+        asyncio.run(start_server_async(local_port, target_ip, target_port, config, reuse_port, prepare_certs))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        _log_start_error(local_port, e)
+
+
+def _log_start_error(local_port, e):
+    if "Address already in use" in str(e):
+        log_proxy(f"端口 {local_port} 已被占用，可能是 Ukey 助手已在本地运行或有僵尸进程，代理不启动。")
+    else:
+        log_proxy(f"代理启动失败: {e}")
+
+
+def _proxy_worker_main(worker_id, local_port, target_ip, target_port, config, reuse_port):
+    """
+    工作进程入口：独立的解释器和事件循环，不和主进程的浏览器自动化抢 GIL
+    """
+    # 日志文件由主进程负责轮转，工作进程只追加
+    configure_log({**config, 'log_max_mb': 0, 'log_rotate_days': 0})
+    metrics_port = int(config.get('proxy_metrics_port', 0))
+    if metrics_port:
+        # 每个工作进程各自统计，指标端口依次顺延
+        config = {**config, 'proxy_metrics_port': metrics_port + worker_id}
+    capture_file = config.get('proxy_capture_file')
+    if capture_file:
+        # 每个工作进程写各自的抓包文件，避免多进程交错写坏记录
+        root, ext = os.path.splitext(capture_file)
+        config = {**config, 'proxy_capture_file': f"{root}.{worker_id}{ext}"}
+    log_proxy(f"代理工作进程 {worker_id} 启动 (pid={os.getpid()})")
+    _run_event_loop(local_port, target_ip, target_port, config, reuse_port, use_uvloop=True, prepare_certs=False)
+
+
+def _run_proxy_workers(workers, local_port, target_ip, target_port, config):
+    """
+    多进程模式：启动 workers 个工作进程共享监听端口，阻塞直到它们全部退出
+    """
+    # 只有支持 SO_REUSEPORT 的平台 (Linux/macOS) 才能让多个进程监听同一端口
+    reuse_port = hasattr(socket, 'SO_REUSEPORT') and sys.platform != 'win32'
+    if not reuse_port and workers > 1:
+        log_proxy("当前平台不支持 SO_REUSEPORT，代理只启动 1 个工作进程")
+        workers = 1
+    workers = min(workers, os.cpu_count() or 1)
+
+    # 证书只在这里生成、安装一次；各工作进程同时生成会互相覆盖磁盘上的文件，
+    # 有的进程就会用着一张签发它的 CA 已经不受信任的证书
+    try:
+        prepare_server_cert(get_base_path())
     except Exception as e:
         log_proxy(f"证书获取失败: {e}")
         return
 
-    # 2. 配置 A 机器监听的 SSL 上下文 (Server 端 - 欺骗浏览器用)
-    server_ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    server_ssl_ctx.load_cert_chain(certfile=cert_path, keyfile=key_path)
+    # 统一用 spawn：主进程里已有日志、MQTT 等线程，fork 出来的子进程状态不可靠
+    mp = multiprocessing.get_context('spawn')
+    processes = []
+    for worker_id in range(workers):
+        process = mp.Process(
+            target=_proxy_worker_main,
+            args=(worker_id, local_port, target_ip, target_port, config, reuse_port),
+            name=f'wsproxy-worker-{worker_id}', daemon=True
+        )
+        process.start()
+        processes.append(process)
 
-    # 3. 配置连接 B 机器的 SSL 上下文 (Client 端 - 连接真实Ukey服务用)
-    client_ssl_ctx = ssl.create_default_context()
-    client_ssl_ctx.check_hostname = False
-    client_ssl_ctx.verify_mode = ssl.CERT_NONE
+    for process in processes:
+        process.join()
+        log_proxy(f"代理工作进程 {process.name} 已退出 (exitcode={process.exitcode})")
 
-    # 4. 启动监听
-    server = await asyncio.start_server(
-        lambda r, w: handle_client(r, w, target_ip, target_port, client_ssl_ctx),
-        '0.0.0.0', local_port, ssl=server_ssl_ctx
-    )
 
-    log_proxy(f"Listening on 127.0.0.1:{local_port} (SSL) -> Forwarding to {target_ip}:{target_port}")
+async def serve(config):
+    """
+    在调用方的事件循环里运行代理 (主程序用，和登录流程、MQTT 共用一个事件循环)，任务被取消时关闭监听
+    proxy_workers 大于 0 时代理仍跑在工作进程里，这里只负责等它们退出
+    """
+    target_ip = config.get('ukey_proxy_target_ip')
+    target_port = config.get('ukey_proxy_target_port')
+    local_port = target_port
+
+    if not (target_ip or config.get('ukey_proxy_targets')) or not target_port:
+        log_proxy("未配置 ukey_proxy_target_ip (或 ukey_proxy_targets) 或 ukey_proxy_target_port，跳过代理启动")
+        return
 
-    async with server:
-        await server.serve_forever()
+    workers = int(config.get('proxy_workers', 0))
+    if workers > 0:
+        # 工作进程是 daemon 的，主程序退出时随之结束；join 放在 daemon 线程里，不拖住事件循环的退出
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+
+        def run_workers():
+            try:
+                _run_proxy_workers(workers, local_port, target_ip, target_port, config)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+                except RuntimeError:
+                    # 事件循环已经关闭
+                    pass
+
+        threading.Thread(target=run_workers, name='wsproxy-workers', daemon=True).start()
+        await finished
+        return
+
+    try:
+        await start_server_async(local_port, target_ip, target_port, config)
+    except OSError as e:
+        _log_start_error(local_port, e)
 
 
 def run_proxy_server():
@@ -184,29 +839,22 @@ def run_proxy_server():
     config = load_config()
     if not config:
         return
+    configure_log(config)
 
     target_ip = config.get('ukey_proxy_target_ip')
     target_port = config.get('ukey_proxy_target_port')
     local_port = target_port
 
-    if not target_ip or not target_port:
-        log_proxy("未配置 ukey_proxy_target_ip 或 ukey_proxy_target_port，跳过代理启动")
+    if not (target_ip or config.get('ukey_proxy_targets')) or not target_port:
+        log_proxy("未配置 ukey_proxy_target_ip (或 ukey_proxy_targets) 或 ukey_proxy_target_port，跳过代理启动")
         return
 
-    # 启动 asyncio循环
-    # Windows 下 asyncio 的 SelectorEventLoop 某些情况有兼容性问题，ProactorEventLoop 通常更好
-    if sys.platform == 'win32':
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-
-    try:
-        asyncio.run(start_server_async(local_port, target_ip, target_port))
-    except KeyboardInterrupt:
-        pass
-    except OSError as e:
-        if "Address already in use" in str(e):
-            log_proxy(f"端口 {local_port} 已被占用，可能是 Ukey 助手已在本地运行或有僵尸进程，代理不启动。")
-        else:
-            log_proxy(f"代理启动失败: {e}")
+    # proxy_workers 大于 0 时代理跑在独立的工作进程里，否则在当前线程里跑
+    workers = int(config.get('proxy_workers', 0))
+    if workers > 0:
+        _run_proxy_workers(workers, local_port, target_ip, target_port, config)
+    else:
+        _run_event_loop(local_port, target_ip, target_port, config)
 
 
 if __name__ == '__main__':